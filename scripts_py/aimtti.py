@@ -0,0 +1,98 @@
+#! /usr/bin/env python
+
+import socket
+
+### persistent client for the TTi pulser server (the one aimtti-cmd.py talks to)
+### one message on /tmp/tti_server_<address>.socket, one reply read with a single recv of
+### at most 1024 bytes, as aimtti-cmd.py does: the server documents no reply terminator
+
+PULSER_ADDRESS = 'aimtti-tgp3152-00'
+
+
+class aimtticlient:
+
+    def __init__(self, address=PULSER_ADDRESS, timeout=5.0, verbose=False):
+        self.address = address
+        self.path = f'/tmp/tti_server_{address}.socket'
+        self.timeout = timeout
+        self.verbose = verbose
+        self.socket = None
+
+
+    def __print_msg__(self, msg):
+        if self.verbose:
+            print(f' [PULSER] {msg}')
+
+
+    def __enter__(self):
+        try:
+            self.connect()
+            return self
+        except OSError as e:
+            self.__print_msg__(f'failed to connect to {self.path}: {e}')
+            self.socket = None
+            return None
+
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+        return False
+
+
+    def connect(self):
+        self.socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.socket.settimeout(self.timeout)
+        self.socket.connect(self.path)
+        self.__print_msg__(f'connected to {self.path}')
+
+
+    def close(self):
+        if self.socket:
+            self.socket.close()
+            self.socket = None
+            self.__print_msg__(f'connection to {self.path} closed')
+
+
+    def __exchange__(self, msg):
+        self.socket.sendall(msg.encode())
+        try:
+            reply = self.socket.recv(1024)
+        except socket.timeout as e:
+            raise RuntimeError(f'no reply from the pulser server {self.path} to {msg!r} within {self.timeout} s') from e
+        if not reply:
+            raise ConnectionError('pulser server closed the connection')
+        return reply.decode().strip()
+
+
+    def send_cmd(self, msg):
+        """Send one message and return the reply, reconnecting once if the server dropped the socket."""
+        if self.socket is None:
+            self.connect()
+        try:
+            reply = self.__exchange__(msg)
+        except (ConnectionError, BrokenPipeError):
+            self.close()
+            self.connect()
+            reply = self.__exchange__(msg)
+        self.__print_msg__(f'{msg} -> {reply}')
+        return reply
+
+
+    def send_cmds(self, msgs):
+        """Send several commands as one ';' separated program message, a single round trip."""
+        return self.send_cmd(';'.join(msgs))
+
+
+    def set_dcoffs(self, voltage, readback=False, tolerance=1e-3):
+        """Set the DC offset, with readback query it in the same message and return the value read."""
+        if not readback:
+            self.send_cmd(f'DCOFFS {voltage}')
+            return voltage
+        reply = self.send_cmds([f'DCOFFS {voltage}', 'DCOFFS?'])
+        try:
+            value = float(reply.split()[-1].rstrip('V'))
+        except (ValueError, IndexError):
+            raise RuntimeError(f'unexpected DCOFFS? reply: {reply!r}')
+        if abs(value - voltage) > tolerance:
+            raise RuntimeError(f'DCOFFS set to {voltage} V but the pulser reports {value} V')
+        return value
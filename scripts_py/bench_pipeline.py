@@ -0,0 +1,252 @@
+#! /usr/bin/env python
+
+import argparse
+import contextlib
+import gc
+import io
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from datetime import datetime
+import numpy as np
+
+from rwave_sim import generate_waveforms, parser as sim_parser
+from rwave import quantize_samples
+from run_dgz import handle_data, save_filtered_waveforms_to_npz, save_waveforms_to_root
+from rwaveclient_root import apply_filter
+from plot_wf import adc_to_mv, calculate_baselines, lowpass_filter
+from calibration_utils import calibrationstats, calibrator, pedestalaccumulator
+from eventbatch import eventbatch, filter_batch
+from waveform_io import chunkwriter
+from features import extract_features
+
+### benchmark suite for the offline waveform pipeline
+### every stage is timed on synthetic X742 batches, results are stored as JSON
+### and can be compared against a previous run to flag regressions
+
+parser = argparse.ArgumentParser(description="Benchmark the offline waveform pipeline on synthetic X742 batches.")
+parser.add_argument("--sizes", type=int, nargs='+', default=[64, 256, 1024],
+                    help="Batch sizes in events (default: 64 256 1024).")
+parser.add_argument("--channels", type=int, default=2, help="Channels per event (default: 2).")
+parser.add_argument("--record_length", type=int, default=1024, help="Samples per waveform (default: 1024).")
+parser.add_argument("--repeat", type=int, default=3, help="Timed repetitions per stage, the best is kept (default: 3).")
+parser.add_argument("--stages", type=str, nargs='+', default=None, help="Run only these stages (default: all).")
+parser.add_argument("--output", type=str, default=None, help="JSON output file (default: ./bench/<timestamp>_<commit>.json).")
+parser.add_argument("--compare", type=str, default=None, help="Previous JSON result to compare against.")
+parser.add_argument("--threshold", type=float, default=0.10,
+                    help="Relative slowdown flagged as a regression (default: 0.10).")
+parser.add_argument("--seed", type=int, default=0, help="Random seed for the synthetic data (default: 0).")
+
+
+def make_batch(rng, n_events, n_channels, record_length=1024, frequency=5000):
+    """Synthetic X742 eventbatch with random trigger tags and DRS4 first cells."""
+    waveforms = generate_waveforms(rng, n_events, n_channels, record_length, frequency, sim_parser.parse_args([]))
+    first_cell = rng.integers(0, 1024, size=n_events)
+    trigger_tag = np.cumsum(rng.integers(1000, 5000, size=n_events))
+    return eventbatch(waveforms, trigger_tag=trigger_tag, first_cell=first_cell)
+
+
+### stages: each one takes (batch, workdir) and returns the callable to time
+
+def stage_handle_data(batch, workdir):
+    return lambda: handle_data(batch)
+
+
+def stage_apply_filter(batch, workdir):
+    event_data = handle_data(batch)
+    return lambda: apply_filter(event_data, threshold=20)
+
+
+def stage_filter_batch(batch, workdir):
+    return lambda: filter_batch(batch.waveforms, threshold=20)
+
+
+def stage_baseline(batch, workdir):
+    waveforms = batch.waveforms.reshape(-1, batch.waveforms.shape[-1])
+    return lambda: calculate_baselines(adc_to_mv(waveforms), 49, 973)
+
+
+def stage_lowpass(batch, workdir):
+    waveforms = adc_to_mv(batch.waveforms.reshape(-1, batch.waveforms.shape[-1]))
+    return lambda: lowpass_filter(waveforms)
+
+
+def stage_calibration_accumulate(batch, workdir):
+    def run():
+        calibration_data = calibrationstats(batch.channels)
+        calibration_data.accumulate(batch, 0.1)
+    return run
+
+
+def stage_calibration_fit(batch, workdir):
+    calibration_data = calibrationstats(batch.channels)
+    for v in np.arange(-0.4, 0.4, 0.15):
+        calibration_data.accumulate(batch, v)
+    return calibration_data.fit
+
+
+def stage_calibration_apply(batch, workdir):
+    n_channels = len(batch.channels)
+    calibration = calibrator(batch.channels, np.full((n_channels, 1024), 1000.0), np.full((n_channels, 1024), 2048.0))
+    return lambda: calibration.apply(batch, adc=True)
+
+
+def stage_pedestal_accumulate(batch, workdir):
+    pedestals = pedestalaccumulator(batch.channels)
+    return lambda: pedestals.accumulate(batch)
+
+
+def stage_features(batch, workdir):
+    return lambda: extract_features(batch.waveforms)
+
+
+def stage_npz_writer(batch, workdir):
+    filtered = apply_filter(handle_data(batch), threshold=0)
+    return lambda: save_filtered_waveforms_to_npz(filtered, os.path.join(workdir, "bench.npz"))
+
+
+def stage_root_writer(batch, workdir):
+    filtered = apply_filter(handle_data(batch), threshold=0)
+    return lambda: save_waveforms_to_root(filtered, os.path.join(workdir, "bench.root"))
+
+
+def stage_quantize(batch, workdir):
+    return lambda: quantize_samples(batch.waveforms)
+
+
+def stage_quantized_writer(batch, workdir):
+    quantized = eventbatch(quantize_samples(batch.waveforms), batch.channels, batch.event_number,
+                           batch.trigger_tag, batch.first_cell)
+    def run():
+        with chunkwriter(os.path.join(workdir, "bench_uint16.wfc"), fsync=False) as writer:
+            writer.write_batch(quantized)
+    return run
+
+
+def stage_roi_writer(batch, workdir):
+    def run():
+        with chunkwriter(os.path.join(workdir, "bench_roi.wfc"), fsync=False, roi_length=150) as writer:
+            writer.write_batch(batch)
+    return run
+
+
+STAGES = {
+    "handle_data": stage_handle_data,
+    "apply_filter": stage_apply_filter,
+    "filter_batch": stage_filter_batch,
+    "baseline": stage_baseline,
+    "lowpass": stage_lowpass,
+    "calibration_accumulate": stage_calibration_accumulate,
+    "calibration_fit": stage_calibration_fit,
+    "calibration_apply": stage_calibration_apply,
+    "pedestal_accumulate": stage_pedestal_accumulate,
+    "features": stage_features,
+    "npz_writer": stage_npz_writer,
+    "root_writer": stage_root_writer,
+    "roi_writer": stage_roi_writer,
+    "quantize": stage_quantize,
+    "quantized_writer": stage_quantized_writer,
+}
+
+
+def measure(run, repeat):
+    """Best wall time over repeat runs, then peak traced memory of one extra run."""
+    times = []
+    with contextlib.redirect_stdout(io.StringIO()):
+        for _ in range(repeat):
+            gc.collect()
+            start = time.perf_counter()
+            run()
+            times.append(time.perf_counter() - start)
+        gc.collect()
+        tracemalloc.start()
+        run()
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+    return min(times), peak
+
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                              check=True, cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except Exception:
+        return None
+
+
+def compare_results(results, baseline, threshold):
+    """Print the relative change of every stage and return the list of regressions."""
+    previous = {(r["stage"], r["n_events"], r["n_channels"]): r for r in baseline["results"]}
+    regressions = []
+    print(f"\nComparison against {baseline['meta'].get('commit')} ({baseline['meta'].get('timestamp')}):")
+    for r in results:
+        old = previous.get((r["stage"], r["n_events"], r["n_channels"]))
+        if old is None:
+            continue
+        change = r["seconds"] / old["seconds"] - 1
+        flag = ""
+        if change > threshold:
+            flag = "  ❌ REGRESSION"
+            regressions.append(r)
+        elif change < -threshold:
+            flag = "  ✅ faster"
+        print(f"  {r['stage']:<24} {r['n_events']:>6} ev  {old['seconds']:9.4f} s -> {r['seconds']:9.4f} s  ({change:+.1%}){flag}")
+    return regressions
+
+
+if __name__ == "__main__":
+    args = parser.parse_args()
+    stages = args.stages if args.stages else list(STAGES)
+    unknown = [name for name in stages if name not in STAGES]
+    if unknown:
+        sys.exit(f"❌ Unknown stage(s): {', '.join(unknown)}. Available: {', '.join(STAGES)}")
+
+    rng = np.random.default_rng(args.seed)
+    results = []
+    with tempfile.TemporaryDirectory() as workdir:
+        for n_events in args.sizes:
+            batch = make_batch(rng, n_events, args.channels, args.record_length)
+            for name in stages:
+                with contextlib.redirect_stdout(io.StringIO()):
+                    run = STAGES[name](batch, workdir)
+                seconds, peak = measure(run, args.repeat)
+                n_waveforms = n_events * args.channels
+                results.append({
+                    "stage": name,
+                    "n_events": n_events,
+                    "n_channels": args.channels,
+                    "record_length": args.record_length,
+                    "seconds": seconds,
+                    "events_per_s": n_events / seconds,
+                    "mb_per_s": n_waveforms * args.record_length * 4 / seconds / 1e6,
+                    "peak_mb": peak / 1e6,
+                })
+                print(f"{name:<24} {n_events:>6} ev  {seconds:9.4f} s  {n_events / seconds:12.1f} ev/s  {peak / 1e6:9.1f} MB peak")
+
+    meta = {
+        "commit": git_commit(),
+        "timestamp": datetime.now().isoformat(timespec="seconds"),
+        "python": platform.python_version(),
+        "numpy": np.__version__,
+        "machine": platform.machine(),
+        "seed": args.seed,
+        "repeat": args.repeat,
+    }
+    output = args.output
+    if output is None:
+        os.makedirs("./bench", exist_ok=True)
+        output = f"./bench/{datetime.now().strftime('%Y%m%d_%H%M%S')}_{meta['commit'] or 'nocommit'}.json"
+    with open(output, "w") as f:
+        json.dump({"meta": meta, "results": results}, f, indent=2)
+    print(f"\nBenchmark results saved as: {output}")
+
+    if args.compare:
+        with open(args.compare) as f:
+            regressions = compare_results(results, json.load(f), args.threshold)
+        if regressions:
+            sys.exit(f"❌ {len(regressions)} regression(s) above {args.threshold:.0%}")
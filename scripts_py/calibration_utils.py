@@ -1,40 +1,54 @@
+import os
 import sys
-import subprocess
 import numpy as np
-import uproot
-import scipy.stats
 import matplotlib.pyplot as plt
 import time
 sys.path.append("/eu/caen-dt5742b/python/")
-from rwave import rwaveclient
+from rwave import rwaveclient, rwavesession
 from rwaveclient_root import acquire_data, handle_data, save_waveforms_to_root
+from eventbatch import eventbatch
+from aimtti import aimtticlient, PULSER_ADDRESS
 import argparse
 from matplotlib.backends.backend_pdf import PdfPages
  
 HOST = 'localhost'
 PORT = 30001
 OUTPUT_FILE = "calibration_data.root"
+CALIBRATION_FILE = "calibration_parameters.npz"
 TREE_NAME = "calibration_tree"
 VOLTAGES = np.arange(-0.4, 0.4, 0.15)  # Voltage range from -0.4V to 0.4V
 
 
 # pulser settings - STILL OK FOR NOW
 ########################################################
+pulser = None
+
+
+def open_pulser(address=PULSER_ADDRESS):
+    """Persistent pulser connection, opened on first use and kept for the whole scan."""
+    global pulser
+    if pulser is None:
+        pulser = aimtticlient(address)
+        pulser.connect()
+    return pulser
+
+
+def close_pulser():
+    """Close the persistent pulser connection, the next open_pulser reconnects."""
+    global pulser
+    if pulser is not None:
+        pulser.close()
+        pulser = None
+
+
 def configure_pulser_calib():
     """Configures pulser for calibration by setting ARB mode and initializing DC offset."""
-    cmds = [
-        "/eu/aimtti/aimtti-cmd.py --address aimtti-tgp3152-00 --cmd 'WAVE ARB'",
-        "/eu/aimtti/aimtti-cmd.py --address aimtti-tgp3152-00 --cmd 'ARBLOAD DC'",
-        "/eu/aimtti/aimtti-cmd.py --address aimtti-tgp3152-00 --cmd 'DCOFFS 0'"
-    ]
-    for cmd in cmds:
-        subprocess.run(cmd, shell=True, check=True)
+    open_pulser().send_cmds(['WAVE ARB', 'ARBLOAD DC', 'DCOFFS 0'])
     time.sleep(0.1)
 
-def set_pulser_voltage(voltage, sleep):
-    """Sets the pulser DC offset."""
-    cmd = f"/eu/aimtti/aimtti-cmd.py --address aimtti-tgp3152-00 --cmd 'DCOFFS {voltage}'"
-    subprocess.run(cmd, shell=True, check=True)
+def set_pulser_voltage(voltage, sleep, readback=False):
+    """Sets the pulser DC offset, optionally reading it back to confirm it."""
+    open_pulser().set_dcoffs(voltage, readback=readback)
     time.sleep(sleep)  # Allow voltage stabilization
 
 
@@ -53,9 +67,366 @@ def set_pulser_voltage(voltage, sleep):
 ########################################################
 import argparse
 import numpy as np
-import scipy.stats as stats
 import matplotlib.pyplot as plt
 
+N_CELLS = 1024
+
+
+def cell_indices(first_cell, record_length, n_cells=N_CELLS):
+    """(events, samples) DRS4 cell whose calibration applies to every sample.
+
+    Sample (cell + first_cell) % n_cells belongs to cell, as in the original per-cell loop.
+    """
+    samples = np.arange(record_length)
+    return (samples[None, :] - np.asarray(first_cell)[:, None]) % n_cells
+
+
+def check_cell_mode(data, by_sample):
+    """Refuse an eventbatch whose DRS4 start cells do not match a per-cell or per-sample (by_sample) table.
+
+    rwave downloads carry no start cell, their tables can only be per sample
+    index; a per-sample table rotated by real start cells would be silently wrong.
+    """
+    if by_sample and data.has_first_cell:
+        raise ValueError('the table is per sample index but the batch has DRS4 start cells')
+    if not by_sample and not data.has_first_cell:
+        raise ValueError('batch has no DRS4 start cell, a per-cell table would be indexed by sample '
+                         '(use a by_sample table)')
+
+
+class calibrationstats:
+    """Per-cell sufficient statistics of a calibration scan.
+
+    count, sum and sum of squares of the amplitudes are kept as
+    (voltage steps, channels, n_cells) arrays, so memory does not grow with
+    the number of events and the fit of all cells is one closed-form step.
+    With by_sample the bins are sample indices instead of DRS4 cells, for
+    batches without a start cell (see check_cell_mode).
+    """
+
+    def __init__(self, channels, voltages=(), n_cells=N_CELLS, by_sample=False):
+        self.channels = tuple(channels)
+        self.n_cells = n_cells
+        self.by_sample = by_sample
+        self.voltages = np.empty(0)
+        shape = (0, len(self.channels), n_cells)
+        self.count = np.zeros(shape, dtype=np.int64)
+        self.sum = np.zeros(shape)
+        self.sum2 = np.zeros(shape)
+        for v in voltages:
+            self.step(v)
+
+
+    def step(self, v):
+        """Index of voltage step v, added if not seen yet."""
+        match = np.flatnonzero(np.isclose(self.voltages, v))
+        if len(match):
+            return match[0]
+        self.voltages = np.append(self.voltages, v)
+        new = np.zeros((1,) + self.count.shape[1:])
+        self.count = np.concatenate([self.count, new.astype(np.int64)])
+        self.sum = np.concatenate([self.sum, new])
+        self.sum2 = np.concatenate([self.sum2, new])
+        return len(self.voltages) - 1
+
+
+    def accumulate(self, data, v):
+        """Add the amplitudes of an eventbatch taken at voltage v."""
+        check_cell_mode(data, self.by_sample)
+        i = self.step(v)
+        waveforms = data.select_channels(self.channels).waveforms
+        n_events, n_channels, record_length = waveforms.shape
+        # flat (channel, cell) bin of every sample, then one bincount per statistic
+        cells = cell_indices(data.first_cell, record_length, self.n_cells)
+        bins = (np.arange(n_channels)[None, :, None] * self.n_cells + cells[:, None, :]).ravel()
+        values = waveforms.ravel().astype(np.float64)
+        size = n_channels * self.n_cells
+        self.count[i] += np.bincount(bins, minlength=size).reshape(n_channels, self.n_cells)
+        self.sum[i] += np.bincount(bins, weights=values, minlength=size).reshape(n_channels, self.n_cells)
+        self.sum2[i] += np.bincount(bins, weights=values * values, minlength=size).reshape(n_channels, self.n_cells)
+
+
+    def moments(self):
+        """(mean, rms) amplitude per voltage step, channel and cell, nan where a cell got no data."""
+        with np.errstate(invalid='ignore', divide='ignore'):
+            mean = self.sum / self.count
+            rms = np.sqrt(np.clip(self.sum2 / self.count - mean ** 2, 0, None))
+        return mean, rms
+
+
+    def step_error(self, v):
+        """Largest uncertainty on the per-cell mean amplitude at voltage v (inf while a cell has < 2 entries)."""
+        i = self.step(v)
+        count = self.count[i]
+        if np.any(count < 2):
+            return np.inf
+        mean = self.sum[i] / count
+        variance = np.clip(self.sum2[i] / count - mean ** 2, 0, None)
+        return float(np.sqrt(variance / count).max())
+
+
+    def fit(self):
+        """Straight line of mean amplitude vs voltage for every channel and cell.
+
+        Returns a dict of (channels, n_cells) arrays with the same quantities
+        as scipy.stats.linregress: slope, intercept, r_value and std_err.
+        """
+        mean, _ = self.moments()
+        valid = self.count > 0
+        v = np.where(valid, self.voltages[:, None, None], 0.0)
+        y = np.where(valid, mean, 0.0)
+        n = valid.sum(axis=0)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            v_mean = v.sum(axis=0) / n
+            y_mean = y.sum(axis=0) / n
+            dv = np.where(valid, v - v_mean, 0.0)
+            dy = np.where(valid, y - y_mean, 0.0)
+            sxx = (dv * dv).sum(axis=0)
+            syy = (dy * dy).sum(axis=0)
+            sxy = (dv * dy).sum(axis=0)
+            slope = sxy / sxx
+            r_value = np.clip(sxy / np.sqrt(sxx * syy), -1.0, 1.0)
+            std_err = np.sqrt((1 - r_value ** 2) * syy / sxx / (n - 2))
+        return {
+            "slope": slope,
+            "intercept": y_mean - slope * v_mean,
+            "r_value": r_value,
+            "std_err": np.where(n > 2, std_err, np.nan),
+        }
+
+
+    def plot_cell(self, fit_results, channel, cell):
+        """Mean amplitude vs voltage of one cell with its fitted line."""
+        c = self.channels.index(channel)
+        mean, _ = self.moments()
+        slope, intercept = fit_results["slope"][c, cell], fit_results["intercept"][c, cell]
+        plt.figure(figsize=(8, 6))
+        plt.scatter(self.voltages, mean[:, c, cell], label='Data', color='blue')
+        plt.plot(self.voltages, slope * self.voltages + intercept, label='Fit', color='red')
+        plt.xlabel('Voltage (V)')
+        plt.ylabel('Mean Amplitude')
+        plt.title(f'Cell {cell}: Slope={slope:.3f}, Intercept={intercept:.3f}')
+        plt.legend()
+        plt.show()
+
+
+class calibrator:
+    """Per-cell linear DRS4 calibration applied to whole eventbatches.
+
+    slope and intercept are (channels, n_cells) arrays, the correction of a
+    batch gathers them at the cell of every sample in one vectorized step.
+    A by_sample table is indexed by sample instead, it only applies to
+    batches without a start cell, like the scan it was fitted from.
+    """
+
+    def __init__(self, channels, slope, intercept, by_sample=False):
+        self.channels = tuple(int(ch) for ch in channels)
+        self.by_sample = bool(by_sample)
+        self.slope = np.ascontiguousarray(slope, dtype=np.float64).reshape(len(self.channels), -1)
+        self.intercept = np.ascontiguousarray(intercept, dtype=np.float64).reshape(len(self.channels), -1)
+        self.n_cells = self.slope.shape[1]
+        self.inverse_slope = 1.0 / self.slope
+
+
+    @classmethod
+    def load(cls, path):
+        """Read a calibration file written by save_calibration_file.
+
+        Files from the older format (one pickled dict per cell of channel 1),
+        or without a by_sample flag, are read as per-cell tables.
+        """
+        with np.load(path) as f:
+            if 'slope' in f.files:
+                by_sample = bool(f['by_sample']) if 'by_sample' in f.files else False
+                return cls(f['channels'], f['slope'], f['intercept'], by_sample)
+        with np.load(path, allow_pickle=True) as f:
+            cells = {int(cell): f[cell].item() for cell in f.files}
+        slope = np.array([cells[cell]["slope"] for cell in sorted(cells)])
+        intercept = np.array([cells[cell]["intercept"] for cell in sorted(cells)])
+        return cls([1], slope, intercept)
+
+
+    def save(self, path):
+        save_calibration_file(path, self.channels, {"slope": self.slope, "intercept": self.intercept}, self.by_sample)
+
+
+    def apply(self, data, adc=False):
+        """Calibrated copy of an eventbatch, in volts or with adc=True in 12-bit ADC counts.
+
+        Channels without calibration are passed through unchanged. The data
+        must be acquired with the digitizer correction off, or it is corrected
+        twice. A batch that does not match the table (start cells for a
+        per-cell table, none for a by_sample one) raises ValueError.
+        """
+        check_cell_mode(data, self.by_sample)
+        waveforms = np.array(data.waveforms, dtype=np.float32)
+        cells = cell_indices(data.first_cell, data.record_length, self.n_cells)
+        for i, ch in enumerate(data.channels):
+            if ch not in self.channels:
+                continue
+            c = self.channels.index(ch)
+            volts = (waveforms[:, i] - self.intercept[c][cells]) * self.inverse_slope[c][cells]
+            # back to adc counts considering 12-bits ADC for -0.5 to 0.5 V
+            waveforms[:, i] = (volts + 0.5) * 4095 if adc else volts
+        return eventbatch(waveforms, data.channels, data.event_number, data.trigger_tag,
+                          data.first_cell if data.has_first_cell else None)
+
+
+def save_calibration_file(path, channels, fit_results, by_sample=False):
+    """Write (channels, n_cells) fit results as plain arrays, loadable without pickle.
+
+    by_sample marks a table indexed by sample instead of by DRS4 cell.
+    """
+    arrays = {key: np.asarray(values, dtype=np.float64) for key, values in fit_results.items()}
+    np.savez(path, channels=np.asarray(channels, dtype=np.int64), by_sample=np.bool_(by_sample), **arrays)
+
+
+class pedestalaccumulator:
+    """Running per-cell pedestal and noise, updated batch by batch.
+
+    mean and m2 (sum of squared deviations) per (channel, DRS4 cell) are
+    merged with the parallel form of Welford's algorithm, so any number of
+    events costs the same memory and the state can be saved and resumed.
+    """
+
+    def __init__(self, channels, n_cells=N_CELLS):
+        self.channels = tuple(int(ch) for ch in channels)
+        self.n_cells = n_cells
+        shape = (len(self.channels), n_cells)
+        self.count = np.zeros(shape, dtype=np.int64)
+        self.mean = np.zeros(shape)
+        self.m2 = np.zeros(shape)
+
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as f:
+            accumulator = cls(f['channels'], f['mean'].shape[1])
+            accumulator.count = f['count']
+            accumulator.mean = f['mean']
+            accumulator.m2 = f['m2']
+        return accumulator
+
+
+    def save(self, path):
+        """Write the state atomically, an interrupted save leaves the previous file intact."""
+        tmp = f'{path}.tmp.npz'
+        np.savez(tmp, channels=np.asarray(self.channels, dtype=np.int64),
+                 count=self.count, mean=self.mean, m2=self.m2)
+        os.replace(tmp, path)
+
+
+    def accumulate(self, data, mask=None, by_sample=False):
+        """Add an eventbatch, optionally only the waveforms selected by an (events, channels) mask.
+
+        Batches without a DRS4 start cell (every rwave download) are refused
+        unless by_sample=True, then the maps are per sample index, not per cell.
+        """
+        if not data.has_first_cell and not by_sample:
+            raise ValueError('batch has no DRS4 start cell, the maps would be per sample index '
+                             '(pass by_sample=True to accumulate them that way)')
+        waveforms = data.select_channels(self.channels).waveforms
+        n_events, n_channels, record_length = waveforms.shape
+        cells = cell_indices(data.first_cell, record_length, self.n_cells)
+        bins = np.arange(n_channels)[None, :, None] * self.n_cells + cells[:, None, :]
+        values = waveforms.astype(np.float64)
+        if mask is not None:
+            keep = np.broadcast_to(np.asarray(mask)[:, :, None], bins.shape)
+            bins, values = bins[keep], values[keep]
+        bins, values = bins.ravel(), values.ravel()
+        size = n_channels * self.n_cells
+
+        # statistics of the batch alone, two passes for stability
+        count = np.bincount(bins, minlength=size)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            mean = np.bincount(bins, weights=values, minlength=size) / count
+        mean[count == 0] = 0.0
+        m2 = np.bincount(bins, weights=(values - mean[bins]) ** 2, minlength=size)
+        count, mean, m2 = (a.reshape(n_channels, self.n_cells) for a in (count, mean, m2))
+
+        # merge with the running state
+        total = self.count + count
+        delta = mean - self.mean
+        with np.errstate(invalid='ignore', divide='ignore'):
+            fraction = np.where(total > 0, count / total, 0.0)
+        self.mean = self.mean + delta * fraction
+        self.m2 = self.m2 + m2 + delta ** 2 * self.count * fraction
+        self.count = total
+
+
+    @property
+    def pedestal(self):
+        """(channels, n_cells) mean, nan for cells without data."""
+        return np.where(self.count > 0, self.mean, np.nan)
+
+
+    @property
+    def noise(self):
+        """(channels, n_cells) sample standard deviation, nan for cells with less than 2 entries."""
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return np.where(self.count > 1, np.sqrt(self.m2 / (self.count - 1)), np.nan)
+
+
+def scan_calibration(session, voltages, calibration_data, block_events=256, target_error=0.2,
+                     max_events=8192, settle_tolerance=1.0, max_settle_blocks=20, sleep=0.0, readback=False):
+    """Run a calibration scan, filling calibration_data, and return one report dict per step.
+
+    Instead of a fixed sleep every step waits until two consecutive blocks of
+    block_events triggers agree on the mean level of every channel within
+    settle_tolerance ADC counts. Blocks are then collected until the largest
+    per-cell mean uncertainty reaches target_error or the step has
+    max_events events; steps stopped by max_events are reported with
+    converged False.
+    """
+    def acquire():
+        return eventbatch(session.acquire(block_events), session.channels)
+
+    def level(batch):
+        return batch.select_channels(calibration_data.channels).waveforms.mean(axis=(0, 2))
+
+    reports = []
+    for k, v in enumerate(voltages):
+        start = time.perf_counter()
+        set_pulser_voltage(v, sleep, readback)
+
+        # settling: discard blocks until the level stops moving
+        previous = acquire()
+        discarded = 0
+        while True:
+            current = acquire()
+            if np.all(np.abs(level(current) - level(previous)) < settle_tolerance):
+                break
+            discarded += 1
+            previous = current
+            if discarded >= max_settle_blocks:
+                print(f"⚠️ {v:.3f} V: not settled after {discarded} blocks, using the data anyway")
+                break
+
+        # collect until the per-cell uncertainty is small enough
+        calibration_data.accumulate(previous, v)
+        calibration_data.accumulate(current, v)
+        n_events = len(previous) + len(current)
+        error = calibration_data.step_error(v)
+        while error > target_error and n_events < max_events:
+            current = acquire()
+            calibration_data.accumulate(current, v)
+            n_events += len(current)
+            error = calibration_data.step_error(v)
+
+        converged = error <= target_error
+        reports.append({"voltage": v, "events": n_events, "discarded": discarded * block_events,
+                        "error": error, "converged": converged, "seconds": time.perf_counter() - start})
+        print(f"Step {k + 1}/{len(voltages)}: {v:+.3f} V, {n_events} events "
+              f"({discarded * block_events} discarded while settling), max cell error {error:.3f} ADC"
+              + ("" if converged else f" ⚠️ above the target {target_error} ADC"))
+
+    failed = [r["voltage"] for r in reports if not r["converged"]]
+    if failed:
+        print(f"⚠️ {len(failed)} steps did not reach {target_error} ADC within {max_events} events: "
+              + ", ".join(f"{v:+.3f} V" for v in failed))
+    return reports
+
+
 def take_calibration_data():
     """Acquire calibration data and perform linear regression for each cell."""
     
@@ -67,7 +438,7 @@ def take_calibration_data():
     parser.add_argument("--vmin", type=float, default=-0.4, help="Minimum voltage for calibration (default: -0.4V).")
     parser.add_argument("--vmax", type=float, default=0.4, help="Maximum voltage for calibration (default: 0.4V).")
     parser.add_argument("--step", type=float, default=0.15, help="Step size for voltage increments (default: 0.15V).")
-    parser.add_argument("--sleep", type=float, default=0.1, help="Sleep time for voltage stabilization (default: 0.1s).")
+    parser.add_argument("--sleep", type=float, default=0.0, help="Extra fixed wait after each voltage change, settling is detected from the data (default: 0s).")
     parser.add_argument("--output_file", type=str, default="calibration_data.root", help="Output ROOT file.")
     parser.add_argument("--plot_cell", type=int, default=0, help="Cell index to plot (default: 0).")
     parser.add_argument("--save_pdf", action="store_true", help="Save plots of all cells to a PDF file.")
@@ -75,6 +446,12 @@ def take_calibration_data():
     parser.add_argument("--plot_waveforms", action="store_true", help="Plot waveforms.")
     parser.add_argument("--save_to_root", action="store_true", help="Save data to ROOT file.")
     parser.add_argument("--save_calibration", action="store_true", help="Save calibration parameters to .npz file.")
+    parser.add_argument("--readback", action="store_true", help="Read every pulser voltage back to confirm it.")
+    parser.add_argument("--block_events", type=int, default=256, help="Triggers per acquisition block (default: 256).")
+    parser.add_argument("--target_error", type=float, default=0.2, help="Target uncertainty on every cell mean, in ADC (default: 0.2).")
+    parser.add_argument("--max_events", type=int, default=8192, help="Maximum events per voltage step (default: 8192).")
+    parser.add_argument("--settle_tolerance", type=float, default=1.0,
+                        help="Level change between blocks below which the pulser is considered settled, in ADC (default: 1.0).")
     
     args = parser.parse_args()
 
@@ -90,72 +467,30 @@ def take_calibration_data():
     save_to_root = args.save_to_root
     save_calibration = args.save_calibration
 
-    # Data structure to hold calibration data
-    calibration_data = {cell: {"voltages": [], "amplitudes": []} for cell in range(1024)}
-
-    configure_pulser_calib()
-
-    for v in voltages:
-        set_pulser_voltage(v, s)
-        data = acquire_data(0x0003)
-        selected_ch = 1
-
-        # Iterate over events and extract waveform values with smart indexing
-        for event_index, event in enumerate(data):
-            first_cell = event[selected_ch]["first_cell"]
-            waveform = event[selected_ch]["waveform"]
-
-            # Access waveform with calculated indices without using np.roll
-            for cell_index in range(1024):
-                aligned_index = (cell_index + first_cell) % 1024
-                amplitude = waveform[aligned_index]
-
-                # Store amplitude and corresponding voltage for each cell
-                calibration_data[cell_index]["voltages"].append(v)
-                calibration_data[cell_index]["amplitudes"].append(amplitude)
-
-    
-    # Perform linear regression for each cell using the mean amplitude across events
-    fit_results = {}
-    for cell, data in calibration_data.items():
-        voltages = np.array(data["voltages"])
-        amplitudes = np.array(data["amplitudes"])
-
-        # Calculate the mean amplitude for each voltage step
-        unique_voltages = np.unique(voltages)
-        mean_amplitudes = np.array([
-            np.mean(amplitudes[voltages == uv]) for uv in unique_voltages
-        ])
-
-        # Perform linear regression using scipy.stats.linregress
-        slope, intercept, r_value, p_value, std_err = stats.linregress(unique_voltages, mean_amplitudes)
-        
-        # Store the fit results
-        fit_results[cell] = {
-            "slope": slope,
-            "intercept": intercept,
-            "r_value": r_value,
-            "std_err": std_err
-        }
-        
-        # Optionally plot the results for a specific cell
-        if plot_waveforms and cell == plot_cell:
-            plt.figure(figsize=(8, 6))
-            plt.scatter(unique_voltages, mean_amplitudes, label='Data', color='blue')
-            plt.plot(unique_voltages, slope * unique_voltages + intercept, label='Fit', color='red')
-            plt.xlabel('Voltage (V)')
-            plt.ylabel('Mean Amplitude')
-            plt.title(f'Cell {cell}: Slope={slope:.3f}, Intercept={intercept:.3f}')
-            plt.legend()
-            plt.show()
+    selected_ch = 1
+    # rwave downloads carry no DRS4 start cell, so the table can only be per sample index
+    calibration_data = calibrationstats([0, 1], voltages, by_sample=True)
+
+    try:
+        configure_pulser_calib()
+        with rwavesession(HOST, PORT, verbose=False) as session:
+            if session is None:
+                sys.exit("❌ Acquisition failed.")
+            # the calibration is applied to uncorrected data, so it is taken without the digitizer correction
+            session.configure(sampling=5000, grmask='0x1', chmask=0x0003, correction=False)
+            reports = scan_calibration(session, voltages, calibration_data, args.block_events, args.target_error,
+                                       args.max_events, args.settle_tolerance, sleep=s, readback=args.readback)
+    finally:
+        close_pulser()
+    print(f"Scan completed in {sum(r['seconds'] for r in reports):.1f} s")
+
+    fit_results = calibration_data.fit()
+    if plot_waveforms:
+        calibration_data.plot_cell(fit_results, selected_ch, plot_cell)
 
     # Optionally save fit results
     if save_calibration:
-        # Convert cell indices to strings before saving
-        fit_results_str = {str(cell): params for cell, params in fit_results.items()}
-
-        # Save with np.savez
-        np.savez("calibration_parameters.npz", **fit_results_str)
+        save_calibration_file(CALIBRATION_FILE, calibration_data.channels, fit_results, calibration_data.by_sample)
 
 
 # testing calibration
@@ -177,6 +512,7 @@ def apply_calibration_to_data():
     parser.add_argument("--plot_waveforms", action="store_true", help="Plot waveforms.")
     parser.add_argument("--save_to_root", action="store_true", help="Save data to ROOT file.")
     parser.add_argument("--save_calibration", action="store_true", help="Save calibration parameters to .npz file.")
+    parser.add_argument("--readback", action="store_true", help="Read every pulser voltage back to confirm it.")
     
     args = parser.parse_args()
 
@@ -192,64 +528,43 @@ def apply_calibration_to_data():
     save_to_root = args.save_to_root
     save_calibration = args.save_calibration
     # Load calibration parameters
-    
-    calibration_data = np.load(load_calibration, allow_pickle=True)
-    calibration_data = {int(cell): calibration_data[cell].item() for cell in calibration_data}
-    
-    # Container for calibrated data to be saved in ROOT format
-    calibrated_data = {cell: {"voltages": [], "amplitudes": []} for cell in range(1024)}
-
-    configure_pulser_calib()
-
-    for v in voltages:
-        set_pulser_voltage(v, s)
-        data = acquire_data(0x0003)
-        selected_ch = 1
-        all_original_waveforms = []
-        all_calibrated_waveforms = []
-        all_uncalibrated_waveforms = []
-        # Iterate over events and extract waveform values with smart indexing
-        for event_index, event in enumerate(data):
-            first_cell = event[selected_ch]["first_cell"]
-            waveform = event[selected_ch]["waveform"]
-            calibrated_waveform = np.zeros(1024, dtype=float)
-            copy_waveform = np.zeros(1024, dtype=float)
-            
-
-            # Access waveform with calculated indices without using np.roll
-            for cell_index in range(1024):
-                aligned_index = (cell_index + first_cell) % 1024
-                slope = calibration_data[cell_index]["slope"]
-                intercept = calibration_data[cell_index]["intercept"]
-                copy_waveform[aligned_index] = (waveform[aligned_index] - intercept) / slope
-                
-                #back to adc counts considering 12-bits ADC for -0.5 to 0.5 V
-                calibrated_waveform[aligned_index] = int((copy_waveform[aligned_index] + 0.5) * 4095)
-
-            all_original_waveforms.append(waveform)
-            all_calibrated_waveforms.append(calibrated_waveform)
-        # # Plot the waveforms for comparison (for the current event)
-        
-
-        if plot_waveforms:
-            plt.figure(figsize=(10, 6))
-            # plt.plot(all_original_waveforms[0], label="Original Waveform", color="blue")
-            plt.plot(all_calibrated_waveforms[0], label="Calibrated Waveform", color="red", linestyle="--")
-            plt.title(f"Waveform Comparison at Voltage {v}V")
-            plt.xlabel("Cell Index")
-            plt.ylabel("Amplitude (Voltage)")
-            plt.legend()
-            plt.show()
+    calibration = calibrator.load(load_calibration)
+
+    try:
+        configure_pulser_calib()
+
+        for v in voltages:
+            set_pulser_voltage(v, s, args.readback)
+            # the offline calibration replaces the digitizer correction, never apply both
+            data = acquire_data(0x0003, correction=False)
+            selected_ch = 1
+            try:
+                calibrated = calibration.apply(data, adc=True)
+            except ValueError as e:
+                sys.exit(f"❌ {load_calibration}: {e}")
+            all_original_waveforms = data.channel(selected_ch)
+            all_calibrated_waveforms = calibrated.channel(selected_ch)
+
+            if plot_waveforms:
+                plt.figure(figsize=(10, 6))
+                # plt.plot(all_original_waveforms[0], label="Original Waveform", color="blue")
+                plt.plot(all_calibrated_waveforms[0], label="Calibrated Waveform", color="red", linestyle="--")
+                plt.title(f"Waveform Comparison at Voltage {v}V")
+                plt.xlabel("Cell Index")
+                plt.ylabel("Amplitude (Voltage)")
+                plt.legend()
+                plt.show()
             
-            plt.figure(figsize=(10, 6))
-            plt.plot(all_original_waveforms[0], label="Original Waveform", color="blue")
-            # plt.plot(all_calibrated_waveforms[1], label="Calibrated Waveform", color="red", linestyle="--")
-            plt.title(f"Waveform Comparison at Voltage {v}V")     
-            plt.xlabel("Cell Index")
-            plt.ylabel("Amplitude (ADC)")
-            plt.legend()
-            plt.show()
-
+                plt.figure(figsize=(10, 6))
+                plt.plot(all_original_waveforms[0], label="Original Waveform", color="blue")
+                # plt.plot(all_calibrated_waveforms[1], label="Calibrated Waveform", color="red", linestyle="--")
+                plt.title(f"Waveform Comparison at Voltage {v}V")     
+                plt.xlabel("Cell Index")
+                plt.ylabel("Amplitude (ADC)")
+                plt.legend()
+                plt.show()
+    finally:
+        close_pulser()
     
 # plotting calibration curves for the selected cell for ch1
 ########################################################
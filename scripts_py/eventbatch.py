@@ -0,0 +1,92 @@
+import numpy as np
+
+
+class eventbatch:
+    """Columnar batch of digitizer events.
+
+    waveforms is an (events, channels, samples) array, event_number,
+    trigger_tag and first_cell are 1-D arrays with one entry per event.
+    Slicing, masking and channel selection return views whenever numpy can.
+    Without a first_cell (rwave downloads do not carry the DRS4 start cell)
+    it is filled with zeros and has_first_cell is False.
+    """
+
+    __slots__ = ('waveforms', 'channels', 'event_number', 'trigger_tag', 'first_cell', 'has_first_cell')
+
+    def __init__(self, waveforms, channels=None, event_number=None, trigger_tag=None, first_cell=None):
+        self.waveforms = np.asarray(waveforms)
+        n_events = len(self.waveforms)
+        self.channels = tuple(range(self.waveforms.shape[1])) if channels is None else tuple(channels)
+        self.event_number = np.arange(n_events) if event_number is None else np.asarray(event_number)
+        self.trigger_tag = np.zeros(n_events, dtype=np.int64) if trigger_tag is None else np.asarray(trigger_tag)
+        self.has_first_cell = first_cell is not None
+        self.first_cell = np.zeros(n_events, dtype=np.int64) if first_cell is None else np.asarray(first_cell)
+
+
+    @classmethod
+    def from_events(cls, data):
+        """Build a batch from the list of {channel: waveform} or {channel: {"waveform", ...}} dicts."""
+        channels = tuple(data[0])
+        if isinstance(data[0][channels[0]], dict):
+            waveforms = np.array([[event[ch]["waveform"] for ch in channels] for event in data])
+            trigger_tag = np.array([event[channels[0]]["trigger_tag"] for event in data])
+            first_cell = np.array([event[channels[0]]["first_cell"] for event in data])
+            return cls(waveforms, channels, trigger_tag=trigger_tag, first_cell=first_cell)
+        return cls(np.array([[event[ch] for ch in channels] for event in data]), channels)
+
+
+    @classmethod
+    def concatenate(cls, batches):
+        """Join batches with the same channels along the event axis."""
+        return cls(np.concatenate([batch.waveforms for batch in batches]),
+                   batches[0].channels,
+                   np.concatenate([batch.event_number for batch in batches]),
+                   np.concatenate([batch.trigger_tag for batch in batches]),
+                   np.concatenate([batch.first_cell for batch in batches])
+                   if all(batch.has_first_cell for batch in batches) else None)
+
+
+    def __len__(self):
+        return len(self.waveforms)
+
+
+    def __getitem__(self, index):
+        """Select events by slice, integer array or boolean mask."""
+        if isinstance(index, (int, np.integer)):
+            index = slice(index, index + 1 or None)
+        return eventbatch(self.waveforms[index], self.channels, self.event_number[index],
+                          self.trigger_tag[index], self.first_cell[index] if self.has_first_cell else None)
+
+
+    def __repr__(self):
+        return f'eventbatch({len(self)} events, channels {self.channels}, {self.record_length} samples)'
+
+
+    @property
+    def record_length(self):
+        return self.waveforms.shape[-1]
+
+
+    def channel(self, ch):
+        """(events, samples) view of the waveforms of channel ch."""
+        return self.waveforms[:, self.channels.index(ch)]
+
+
+    def select_channels(self, channels):
+        """Batch restricted to the given channels, in the given order."""
+        indices = [self.channels.index(ch) for ch in channels]
+        if indices == list(range(indices[0], indices[-1] + 1)):
+            waveforms = self.waveforms[:, indices[0]:indices[-1] + 1]
+        else:
+            waveforms = self.waveforms[:, indices]
+        return eventbatch(waveforms, channels, self.event_number, self.trigger_tag,
+                          self.first_cell if self.has_first_cell else None)
+
+
+def filter_batch(waveforms, threshold=20, window_size=900):
+    """Return the (events, channels) mask of waveforms whose central peak-to-peak exceeds threshold."""
+    record_length = waveforms.shape[-1]
+    start_idx = max(0, (record_length - window_size) // 2)
+    central_window = waveforms[..., start_idx:start_idx + window_size]
+    peak_to_peak = central_window.max(axis=-1) - central_window.min(axis=-1)
+    return peak_to_peak > threshold
@@ -0,0 +1,76 @@
+import numpy as np
+
+### pulse features computed for a whole (events, channels, samples) batch at once
+### times are in ns from the first sample, charge in ADC x ns, amplitudes in ADC above baseline
+
+FEATURE_NAMES = ['baseline', 'amplitude', 'charge', 'peak_time', 'rise_time', 'cfd_time']
+FEATURE_COLUMNS = {'event_number': np.int64, 'trigger_tag': np.int64, 'first_cell': np.int32, 'channel': np.uint8,
+                   **{name: np.float32 for name in FEATURE_NAMES}}
+
+
+def crossing_time(signal, level, peak_index):
+    """Interpolated sample where signal last rises through level before peak_index, nan if it never does."""
+    samples = np.arange(signal.shape[-1])
+    below = (signal < level[..., None]) & (samples < peak_index[..., None])
+    before = np.where(below, samples, -1).max(axis=-1)
+    found = before >= 0
+    i0 = np.clip(before, 0, signal.shape[-1] - 2)
+    s0 = np.take_along_axis(signal, i0[..., None], axis=-1)[..., 0]
+    s1 = np.take_along_axis(signal, i0[..., None] + 1, axis=-1)[..., 0]
+    with np.errstate(invalid='ignore', divide='ignore'):
+        fraction = np.clip((level - s0) / (s1 - s0), 0.0, 1.0)
+    return np.where(found, i0 + fraction, np.nan)
+
+
+def extract_features(waveforms, frequency=5000, polarity=-1, baseline_samples=(0, 200),
+                     integration=(5.0, 50.0), rise_fractions=(0.1, 0.9), cfd_fraction=0.2):
+    """Return a dict of (events, channels) feature arrays, see FEATURE_NAMES.
+
+    polarity=-1 is for negative (SiPM) pulses; the baseline is the mean of
+    baseline_samples, the charge is integrated from integration[0] ns before
+    to integration[1] ns after the peak.
+    """
+    waveforms = np.asarray(waveforms, dtype=np.float32)
+    samples_per_ns = frequency / 1000.0
+    n_samples = waveforms.shape[-1]
+
+    baseline = waveforms[..., baseline_samples[0]:baseline_samples[1]].mean(axis=-1)
+    signal = polarity * (waveforms - baseline[..., None])
+    peak_index = signal.argmax(axis=-1)
+    amplitude = np.take_along_axis(signal, peak_index[..., None], axis=-1)[..., 0]
+
+    # charge from a cumulative sum, one gather per window edge
+    cumulative = np.concatenate([np.zeros(signal.shape[:-1] + (1,), dtype=np.float64),
+                                 np.cumsum(signal, axis=-1, dtype=np.float64)], axis=-1)
+    start = np.clip(peak_index - int(round(integration[0] * samples_per_ns)), 0, n_samples)
+    end = np.clip(peak_index + int(round(integration[1] * samples_per_ns)), 0, n_samples)
+    charge = (np.take_along_axis(cumulative, end[..., None], axis=-1)
+              - np.take_along_axis(cumulative, start[..., None], axis=-1))[..., 0] / samples_per_ns
+
+    low, high = (crossing_time(signal, fraction * amplitude, peak_index) for fraction in rise_fractions)
+    cfd = crossing_time(signal, cfd_fraction * amplitude, peak_index)
+
+    return {
+        'baseline': baseline,
+        'amplitude': amplitude,
+        'charge': charge.astype(np.float32),
+        'peak_time': peak_index / samples_per_ns,
+        'rise_time': (high - low) / samples_per_ns,
+        'cfd_time': cfd / samples_per_ns,
+    }
+
+
+def feature_table(batch, features, mask=None):
+    """Flatten per-waveform features of an eventbatch into 1-D columns, optionally keeping an (events, channels) mask."""
+    if mask is None:
+        mask = np.ones(batch.waveforms.shape[:2], dtype=bool)
+    event_index, channel_index = np.nonzero(mask)
+    table = {
+        'event_number': batch.event_number[event_index],
+        'trigger_tag': batch.trigger_tag[event_index],
+        'first_cell': batch.first_cell[event_index],
+        'channel': np.asarray(batch.channels)[channel_index],
+    }
+    for name in FEATURE_NAMES:
+        table[name] = features[name][event_index, channel_index]
+    return table
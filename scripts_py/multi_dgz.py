@@ -0,0 +1,107 @@
+import asyncio
+import numpy as np
+
+from rwave import asyncrwaveclient
+
+
+def parse_boards(specs, default_port=30001):
+    """Turn ['host:port', 'host', ...] into a list of (host, port) tuples."""
+    boards = []
+    for spec in specs:
+        host, _, port = spec.partition(':')
+        boards.append((host, int(port) if port else default_port))
+    return boards
+
+
+def build_events(batches, trigger_tags=None, tolerance=0):
+    """Merge per-board (E_b, C_b, S) batches into combined events.
+
+    Without trigger tags boards are aligned by event index. With one tag
+    array per board, every event of board 0 is matched to the nearest tag
+    of each other board and kept only if all of them are within tolerance.
+    Returns the (E, sum(C_b), S) array and the board 0 event indices kept.
+    Events that cannot be matched are dropped with a warning.
+    """
+    if trigger_tags is None:
+        n_events = min(len(batch) for batch in batches)
+        if any(len(batch) != n_events for batch in batches):
+            print(f"⚠️ Boards returned {[len(batch) for batch in batches]} events, "
+                  f"keeping the first {n_events} of each")
+        indices = [np.arange(n_events)] * len(batches)
+    else:
+        reference = np.asarray(trigger_tags[0], dtype=np.int64)
+        keep = np.ones(len(reference), dtype=bool)
+        indices = [np.arange(len(reference))]
+        for tags in trigger_tags[1:]:
+            tags = np.asarray(tags, dtype=np.int64)
+            order = np.argsort(tags, kind='stable')
+            sorted_tags = tags[order]
+            # nearest neighbour of every reference tag among the sorted board tags
+            right = np.searchsorted(sorted_tags, reference).clip(0, len(tags) - 1)
+            left = (right - 1).clip(0, len(tags) - 1)
+            nearest = np.where(np.abs(sorted_tags[left] - reference) <= np.abs(sorted_tags[right] - reference), left, right)
+            keep &= np.abs(sorted_tags[nearest] - reference) <= tolerance
+            indices.append(order[nearest])
+        if not keep.all():
+            print(f"⚠️ {np.count_nonzero(~keep)} of {len(keep)} events without a matching trigger tag on every board dropped")
+        indices = [index[keep] for index in indices]
+    events = np.concatenate([batch[index] for batch, index in zip(batches, indices)], axis=1)
+    return events, indices[0]
+
+
+class multiboardsession:
+    """One asyncrwaveclient per board, driven concurrently from a private event loop.
+
+    Exposes the same configure/acquire interface as rwave.rwavesession, with
+    the boards' channels concatenated in the order the boards were given and
+    numbered 0..N-1; channel_map gives the ('host:port', board channel) of each.
+    """
+
+    def __init__(self, boards, verbose=True):
+        self.clients = [asyncrwaveclient(host, port, verbose) for host, port in boards]
+        self.channels = ()
+        self.channel_map = ()
+        self.loop = None
+
+
+    def __gather__(self, coros):
+        async def gather():
+            return await asyncio.gather(*coros)
+        return self.loop.run_until_complete(gather())
+
+
+    def __enter__(self):
+        self.loop = asyncio.new_event_loop()
+        opened = self.__gather__(client.__aenter__() for client in self.clients)
+        if any(client is None for client in opened):
+            self.__exit__(None, None, None)
+            return None
+        return self
+
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        # safe to call twice: __enter__ already cleans up when a board fails to connect
+        if self.loop is None or self.loop.is_closed():
+            return False
+        self.__gather__(client.__aexit__(exc_type, exc_value, traceback) for client in self.clients)
+        self.loop.close()
+        self.loop = None
+        return False
+
+
+    def configure(self, **settings):
+        """Apply the same settings to every board, sending only what changed."""
+        return self.__gather__(client.configure(**settings) for client in self.clients)
+
+
+    def acquire(self, n_triggers=1024, quantize=False):
+        """Trigger and download all boards in parallel and merge them by event index.
+
+        rwave downloads carry no trigger time tag, so the tag matching of
+        build_events cannot be used here and the boards are aligned by index.
+        """
+        batches = self.__gather__(client.acquire(n_triggers, quantize) for client in self.clients)
+        events, _ = build_events(batches)
+        self.channel_map = tuple((f'{client.host}:{client.port}', ch) for client in self.clients for ch in client.channels)
+        self.channels = tuple(range(len(self.channel_map)))
+        return events
@@ -1,66 +1,104 @@
 import os
 import argparse
+import functools
 import numpy as np
 import matplotlib.pyplot as plt
-from scipy.signal import butter, filtfilt
+from scipy.signal import butter, sosfilt, sosfilt_zi, sosfiltfilt
+from waveform_io import chunkreader
 
-# Look for the most recent .npz file in the ./data directory
+# Look for the most recent .npz or chunked .wfc file in the ./data directory
 def find_latest_npz_file(data_dir="./data"):
-    files = [f for f in os.listdir(data_dir) if f.endswith(".npz")]
+    files = [f for f in os.listdir(data_dir) if f.endswith((".npz", ".wfc"))]
     if not files:
-        raise FileNotFoundError("No .npz files found in ./data")
+        raise FileNotFoundError("No .npz or .wfc files found in ./data")
     files.sort(reverse=True)
     return os.path.join(data_dir, files[0])
 
-# Load waveform data from a .npz file
+# Load waveform data from a .npz file or a (possibly interrupted) chunked .wfc file
 def load_waveforms(npz_path):
+    if npz_path.endswith(".wfc"):
+        data = chunkreader(npz_path)
+        if not data.complete:
+            print(f"⚠️ {npz_path} was not closed, reading the {len(data)} waveforms written before the interruption")
+        return data
     data = np.load(npz_path)
     return data
 
 # Convert ADC counts to millivolts (assuming 12-bit ADC centered at 2048)
 def adc_to_mv(adc_array):
+    adc_array = np.asarray(adc_array, dtype=np.float64)  # quantized uint16 data would wrap around
     return ((adc_array - 2048) / 4096.0) * 1000  # mV
 
-# Apply low-pass Butterworth filter to reduce noise
-def lowpass_filter(wf, cutoff_hz=200e6, fs=5e9, order=4):
+# Second-order sections of a low-pass Butterworth filter, designed once per (cutoff, fs, order)
+@functools.lru_cache(maxsize=32)
+def lowpass_sos(cutoff_hz=200e6, fs=5e9, order=4):
     nyq = fs / 2.0
     normal_cutoff = cutoff_hz / nyq
-    b, a = butter(order, normal_cutoff, btype='low', analog=False)
-    filtered = filtfilt(b, a, wf)
-    return filtered
+    return butter(order, normal_cutoff, btype='low', analog=False, output='sos')
+
+# Apply low-pass Butterworth filter to reduce noise, zero phase along the sample axis
+# of a single waveform or of a whole (N, samples) batch
+def lowpass_filter(wf, cutoff_hz=200e6, fs=5e9, order=4):
+    return sosfiltfilt(lowpass_sos(cutoff_hz, fs, order), wf, axis=-1)
+
+# Causal low-pass filter for continuous streams, the state is carried from one chunk to the next
+class streamfilter:
+
+    def __init__(self, cutoff_hz=200e6, fs=5e9, order=4):
+        self.sos = lowpass_sos(cutoff_hz, fs, order)
+        self.zi = None
+
+    def reset(self):
+        self.zi = None
+
+    def __call__(self, chunk):
+        chunk = np.asarray(chunk, dtype=np.float64)
+        if self.zi is None:
+            # start in steady state at the first sample of every stream to avoid the step response
+            zi = sosfilt_zi(self.sos)
+            self.zi = zi.reshape((zi.shape[0],) + (1,) * (chunk.ndim - 1) + (2,)) * chunk[..., :1]
+        filtered, self.zi = sosfilt(self.sos, chunk, axis=-1, zi=self.zi)
+        return filtered
+
+# Baselines of a whole (N, samples) batch, excluding the regions around signal candidates
+def calculate_baselines(waveforms, baseline_start, baseline_end, window_size=20, ptp_threshold=5.0,
+                        pre_margin=30, post_margin=150, method='median'):
+    waveforms = np.asarray(waveforms)
+    region = waveforms[..., baseline_start:baseline_end]
+    num_points = region.shape[-1]
+
+    # Peak-to-peak over strided sliding windows (same windows as the original loop)
+    windows = np.lib.stride_tricks.sliding_window_view(region, window_size, axis=-1)[..., :num_points - window_size, :]
+    peaks = windows.max(axis=-1) - windows.min(axis=-1) > ptp_threshold
+
+    # Dilate the peaks by [-pre_margin, +post_margin): sample j is excluded if a peak
+    # starts in (j - post_margin, j + pre_margin], counted with a cumulative sum
+    counts = np.concatenate([np.zeros(peaks.shape[:-1] + (1,), dtype=np.int64), np.cumsum(peaks, axis=-1)], axis=-1)
+    j = np.arange(num_points)
+    upper = np.clip(j + pre_margin + 1, 0, peaks.shape[-1])
+    lower = np.clip(j - post_margin + 1, 0, peaks.shape[-1])
+    usable = counts[..., upper] - counts[..., lower] == 0
+
+    # Median or mean of the usable samples, the whole region when nothing is left
+    masked = np.where(usable, region, np.nan)
+    reduce = np.nanmedian if method == 'median' else np.nanmean
+    with np.errstate(all='ignore'):
+        empty = ~usable.any(axis=-1)
+        if empty.any():
+            masked[empty] = region[empty]
+        baselines = reduce(masked, axis=-1)
+    return baselines, usable
 
 # Calculate baseline using a region while excluding potential signal contamination
 def calculate_baseline_with_mask(wf, baseline_start, baseline_end, window_size=20, ptp_threshold=5.0, pre_margin=30, post_margin=150):
-    region = wf[baseline_start:baseline_end]
-    num_points = len(region)
-    region_indices = np.arange(baseline_start, baseline_end)
-
-    # Compute peak-to-peak value over sliding windows
-    ptp = np.array([
-        np.ptp(region[i:i+window_size])
-        for i in range(num_points - window_size)
-    ])
-    # Detect regions likely containing signal
-    peak_indices = np.where(ptp > ptp_threshold)[0] + baseline_start
-
-    # Create mask to exclude signal + margins
-    exclude_mask = np.zeros_like(wf, dtype=bool)
-    for idx in peak_indices:
-        start = max(0, idx - pre_margin)
-        end = min(len(wf), idx + post_margin)
-        exclude_mask[start:end] = True
-
-    # Keep only valid indices for baseline calculation
-    usable_indices = region_indices[~exclude_mask[baseline_start:baseline_end]]
-
-    if len(usable_indices) > 0:
-        baseline = np.median(wf[usable_indices])
-    else:
-        baseline = np.median(region)
+    baselines, usable = calculate_baselines(wf[None], baseline_start, baseline_end, window_size,
+                                            ptp_threshold, pre_margin, post_margin)
+    usable_indices = np.flatnonzero(usable[0]) + baseline_start
+    if len(usable_indices) == 0:
         usable_indices = np.array([])
 
     print(f"✅ {len(usable_indices)} samples used for baseline after excluding signal + margins")
-    return baseline, usable_indices
+    return baselines[0], usable_indices
 
 # Helper to group consecutive indices (for plotting spans)
 def group_consecutive(indices):
@@ -80,6 +118,9 @@ def plot_first_waveform(data, unit='ADC'):
     baseline_start, baseline_end = 49, 973
 
     for key in data.files:
+        # only waveform arrays, not the 'roi' segments or the per-waveform info of .wfc files
+        if not key.startswith('waveform'):
+            continue
         wf_array = data[key]
         if wf_array.ndim == 2 and wf_array.shape[0] > 0:
             wf_adc = wf_array[0]
@@ -137,8 +178,8 @@ def plot_filtered_vs_raw(wf, filtered_wf, title="Low-pass filter effect"):
 
 # Command line interface to select file and units
 if __name__ == "__main__":
-    parser = argparse.ArgumentParser(description="Plot waveforms from a saved .npz file.")
-    parser.add_argument("--file", type=str, help="Name of the .npz file to load from ./data/")
+    parser = argparse.ArgumentParser(description="Plot waveforms from a saved .npz or .wfc file.")
+    parser.add_argument("--file", type=str, help="Name of the .npz or .wfc file to load from ./data/")
     parser.add_argument("--unit", choices=["ADC", "mV"], default="ADC", help="Unit for waveform plot.")
     args = parser.parse_args()
 
@@ -9,9 +9,9 @@ def load_data_from_root(filename):
         tree = file["waveform_tree"]
         
         # Estrai i dati per ogni canale (ch0, ch1) e gli eventi
-        events = tree["event"].array()
-        ch0_data = tree["ch0_waveform"].array()
-        ch1_data = tree["ch1_waveform"].array()
+        events = tree["event_number"].array(library="np")
+        ch0_data = tree["waveform_ch0"].array(library="np")
+        ch1_data = tree["waveform_ch1"].array(library="np")
         
     return events, ch0_data, ch1_data
 
@@ -2,13 +2,21 @@ import sys
 import numpy as np
 import argparse
 import matplotlib.pyplot as plt
-import uproot
 from tqdm import tqdm  # Barra di avanzamento
 from datetime import datetime
 import os
+import contextlib
+import queue
+import threading
+import time
 
 sys.path.append("/eu/caen-dt5742b/python/")
-from rwave import rwaveclient
+from rwave import rwavesession
+from multi_dgz import multiboardsession, parse_boards
+from eventbatch import eventbatch, filter_batch
+from waveform_io import chunkwriter, rootwriter, featurewriter, write_channel_map
+from calibration_utils import calibrator, pedestalaccumulator
+from features import extract_features, feature_table, FEATURE_COLUMNS
 
 parser = argparse.ArgumentParser(description="Receive and save waveform data from CAEN digitizer.")
 parser.add_argument("--filter_ADC", type=float, default=None,
@@ -23,94 +31,95 @@ parser.add_argument("--sampling", type=float, default=5000,
                     help="Sampling frequency in MHz (default: 5.0 MHz)")
 parser.add_argument("--vbias", type=float, required=True,
     help="Bias voltage applied to the SiPM (in volts, e.g., 35)")
-args = parser.parse_args()
+parser.add_argument("--boards", type=str, nargs='+', default=None,
+                    help="Acquire concurrently from several rwave servers (e.g., --boards host1:30001 host2:30001).")
+parser.add_argument("--root", action="store_true",
+                    help="Also write the accepted events to a single waveform_tree in a ROOT file.")
+parser.add_argument("--basket_size", type=int, default=1024,
+                    help="Events per ROOT basket when writing with --root (default: 1024).")
+parser.add_argument("--pipeline", action="store_true",
+                    help="Acquire the next batch in a background thread while the current one is processed.")
+parser.add_argument("--queue_size", type=int, default=2,
+                    help="Maximum number of acquired batches waiting to be processed in pipeline mode (default: 2).")
+parser.add_argument("--calibration", type=str, default=None,
+                    help="Apply the per-cell DRS4 calibration of this file to every batch (ADC units are kept). "
+                         "The digitizer correction is turned off; rwave data has no DRS4 start cell, "
+                         "so only calibrations taken per sample index (calibration_utils scans) can be applied.")
+parser.add_argument("--pedestals", type=str, default=None,
+                    help="Accumulate per-cell pedestal and noise maps in this file, resuming it if it exists. "
+                         "rwave data has no DRS4 start cell, so the maps are per sample index.")
+parser.add_argument("--pedestal_save_every", type=int, default=10,
+                    help="Save the pedestal maps every N batches and at the end of the run (default: 10).")
+parser.add_argument("--features", action="store_true",
+                    help="Write only the pulse feature table (feature_tree) instead of the raw waveforms.")
+parser.add_argument("--raw_prescale", type=int, default=None,
+                    help="With --features, also keep the raw waveforms of one event every N.")
+parser.add_argument("--roi", type=int, default=None,
+                    help="Zero suppression: store only N samples around the pulse of every waveform (e.g., --roi 150).")
+parser.add_argument("--quantize", action="store_true",
+                    help="Keep raw (uncorrected) waveforms as 12-bit uint16 ADC codes from download to storage.")
 
-# safety check for bias voltage
-if not (10.0 <= args.vbias <= 80.0):
-    print(f"⚠️ Warning: Vbias {args.vbias} V seems out of expected range (10–80 V).")
+HOST = 'localhost'
+PORT = 30001
+TREE_NAME = "waveform_tree"
 
 
-# Create data directory if it doesn't exist
-os.makedirs("./data", exist_ok=True)
 
-HOST = 'localhost'
-PORT = 30001
+def acquire_data(chmask, correction=True, session=None, sampling=5000, quantize=False, first_event=0):
+    """Acquire waveform data from the digitizer, reusing an open session if given.
 
-timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-OUTPUT_FILE = f"./data/{timestamp}_waveforms_bias{args.vbias}_{int((args.sampling)/1000)}GS.root"
-NPZ_FILE = f"./data/{timestamp}_waveforms_bias{args.vbias}_{int(args.sampling)/1000}GS.npz"
-TREE_NAME = "waveform_tree"
+    Events are numbered from first_event, so numbers keep increasing over a run.
+    """
+    if session is None:
+        with rwavesession(HOST, PORT, verbose=True) as session:
+            if session is None:
+                return None
+            return acquire_data(chmask, correction, session, sampling, quantize, first_event)
 
+    session.configure(sampling=int(sampling), grmask='0x1', chmask=chmask, correction=correction)
+    data = session.acquire(1024, quantize=quantize)
+    return eventbatch(data, session.channels, event_number=first_event + np.arange(len(data)))
 
 
-def acquire_data(chmask, correction):
-    """Acquire waveform data from the digitizer."""
-    with rwaveclient(HOST, PORT, verbose=True) as rwc:
-        if rwc is None:
-            return None
+def acquisition_worker(session, batches, stop_event, timing, sampling=5000, quantize=False, correction=True):
+    """Fill the batch queue from a background thread until stop_event is set."""
+    n_acquired = 0
+    while not stop_event.is_set():
+        start = time.perf_counter()
+        try:
+            data = acquire_data(0x0003, correction=correction, session=session, sampling=sampling,
+                                quantize=quantize, first_event=n_acquired)
+        except Exception as e:
+            print(f"❌ Acquisition thread error: {e}")
+            data = None
+        timing["acquire"] += time.perf_counter() - start
 
-        rwc.send_cmd(f'sampling {int(args.sampling)}')
-        rwc.send_cmd('grmask 0x1')
-        rwc.send_cmd(f'chmask {chmask}')
-        rwc.send_cmd('correction on' if correction else 'correction off')
-        rwc.send_cmd("start")
-        rwc.send_cmd('swtrg 1024')
-        rwc.send_cmd('readout')
-        rwc.send_cmd('download')
-        data = rwc.download()
-        rwc.send_cmd('stop')
+        # Bounded queue: block (digitizer idle) while the consumer is behind
+        start = time.perf_counter()
+        while not stop_event.is_set():
+            try:
+                batches.put(data, timeout=0.1)
+                break
+            except queue.Full:
+                continue
+        timing["blocked"] += time.perf_counter() - start
 
-        return data
+        if data is None:
+            return
+        n_acquired += len(data)
 
 
 def handle_data(data, selected_ch=None):
-    """Process waveform data and return one dictionary per event."""
+    """Return the acquired events as an eventbatch restricted to the selected channels."""
     if data is None:
         print("No data received.")
         return None
 
-    all_events_data = []
-    max_channels = len(data[0])
-
+    if not isinstance(data, eventbatch):
+        data = eventbatch.from_events(data)
     if selected_ch is not None:
-        active_channels = selected_ch
-    else:
-        active_channels = range(max_channels)
-
-    for event_number, event in enumerate(data):
-        for ch in active_channels:
-            waveform = event[ch]["waveform"]
-            tree_data = {
-                "event_number": np.array([event_number]),
-                f'waveform_ch{ch}': np.array([waveform]),
-                "trigger_tag": np.array([event[0]["trigger_tag"]]),
-                "first_cell": np.array([event[0]["first_cell"]]),
-                "num_cells": np.array([np.arange(len(waveform))])
-            }
-            all_events_data.append(tree_data)
-
-    return all_events_data
-
-
-def apply_filter(event_data, threshold=20, window_size=900):
-    """Filter waveform events based on central peak-to-peak amplitude."""
-    start_idx = (1024 - window_size) // 2
-    end_idx = start_idx + window_size
-    filtered_dict = {}
-
-    for event in event_data:
-        for key in event:
-            if key.startswith("waveform_ch"):
-                ch = key.split("waveform_ch")[1]
-                wf = event[key].squeeze()
-                central_window = wf[start_idx:end_idx]
-                peak_to_peak = central_window.max() - central_window.min()
-                if peak_to_peak > threshold:
-                    if f'waveform_ch{ch}' not in filtered_dict:
-                        filtered_dict[f'waveform_ch{ch}'] = []
-                    filtered_dict[f'waveform_ch{ch}'].append(wf)
-
-    return filtered_dict
+        data = data.select_channels(selected_ch)
+    return data
 
 
 def save_filtered_waveforms_to_npz(filtered_dict, output_file):
@@ -125,31 +134,45 @@ def save_filtered_waveforms_to_npz(filtered_dict, output_file):
     return bool(filtered_dict)
 
 
-def save_waveforms_to_root(filtered_dict, output_file):
-    """Save filtered waveforms into separate ROOT files per channel."""
+def save_waveforms_to_root(filtered_dict, output_file, basket_size=1024):
+    """Save filtered waveforms into one waveform_tree per channel file."""
+    directory, name = os.path.split(output_file)
     for ch_key, waveforms in filtered_dict.items():
-        ch = ch_key.replace("waveform_ch", "")
-        with uproot.recreate(f'ch{ch}_{output_file}') as file:
-            for i, wf in enumerate(waveforms):
-                file[f"{TREE_NAME}_event_{i}"] = {
-                    "event_number": np.array([i]),
-                    f"waveform_ch{ch}": np.array([wf]),
-                    "trigger_tag": np.array([0]),
-                    "first_cell": np.array([0]),
-                    "num_cells": np.array([np.arange(len(wf))])
-                }
-        print(f"ROOT file saved: ch{ch}_{output_file}")
-
+        ch = int(ch_key.replace("waveform_ch", ""))
+        waveforms = np.asarray(waveforms)
+        ch_file = os.path.join(directory, f'ch{ch}_{name}')
+        with rootwriter(ch_file, [ch], waveforms.shape[-1], TREE_NAME, basket_size) as writer:
+            writer.write_batch(eventbatch(waveforms[:, None], [ch]))
+        print(f"ROOT file saved: {ch_file}")
 
 if __name__ == "__main__":
+    args = parser.parse_args()
+
+    # safety check for bias voltage
+    if not (10.0 <= args.vbias <= 80.0):
+        print(f"⚠️ Warning: Vbias {args.vbias} V seems out of expected range (10–80 V).")
+
+    # Create data directory if it doesn't exist
+    os.makedirs("./data", exist_ok=True)
+
+    timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
+    OUTPUT_FILE = f"./data/{timestamp}_waveforms_bias{args.vbias}_{int((args.sampling)/1000)}GS.root"
+    DATA_FILE = f"./data/{timestamp}_waveforms_bias{args.vbias}_{int(args.sampling)/1000}GS.wfc"
+    FEATURE_FILE = f"./data/{timestamp}_features_bias{args.vbias}_{int(args.sampling)/1000}GS.root"
+
     selected_channels = args.channel if args.channel else None
     print(f"Selected channels: {selected_channels}")
 
+    calibration = calibrator.load(args.calibration) if args.calibration else None
+    if calibration is not None:
+        print(f"Applying calibration {args.calibration} to channels {calibration.channels}"
+              f"{' (per sample index)' if calibration.by_sample else ''}")
+    # quantized codes and the offline calibration both need the raw, uncorrected samples
+    correction = not (args.quantize or calibration is not None)
+
     min_events = args.min_events
     print(f"Accumulating at least {min_events} valid waveforms.")
 
-    # Initialize list to store valid waveforms
-    valid_waveforms = []
     run_count = 0
 
     # Open log file
@@ -160,46 +183,142 @@ if __name__ == "__main__":
         # Barra di avanzamento
         pbar = tqdm(total=min_events, desc="Accumulating waveforms", ncols=100, unit="waveforms")
 
-        while len(valid_waveforms) < min_events:
-            run_count += 1
-            print(f"\nRun {run_count}: Accumulating waveforms... ({len(valid_waveforms)} / {min_events})")
-            data = acquire_data(0x0003, correction=True)
-            if data is None:
+        # One connection (per board) for the whole run, settings are sent only when they change
+        if args.boards:
+            run_session = multiboardsession(parse_boards(args.boards, default_port=PORT), verbose=True)
+        else:
+            run_session = rwavesession(HOST, PORT, verbose=True)
+        # Every accepted batch is flushed to DATA_FILE right away, RAM holds one batch at most
+        with run_session as session, contextlib.ExitStack() as outputs:
+            if session is None:
                 sys.exit("❌ Acquisition failed.")
-
-            event_data = handle_data(data, selected_ch=selected_channels)
-            if event_data is None:
-                sys.exit("❌ No events to process.")
-
-            if args.filter_ADC is not None:
-                print(f"🔍 Applying filter: peak-to-peak > {args.filter_ADC} ADC")
-                filtered = apply_filter(event_data, threshold=args.filter_ADC)
-
-                # Append valid waveforms to the list
-                for ch_key, waveforms in filtered.items():
-                    valid_waveforms.extend(waveforms)
-
-                print(f"Waveforms after filtering: {len(valid_waveforms)}")
-            else:
-                print("No filter applied. Saving all waveforms.")
-                for event in event_data:
-                    for ch_key in event:
-                        if ch_key.startswith("waveform_ch"):
-                            valid_waveforms.append(event[ch_key])
-
-            # Update barra di avanzamento
-            pbar.update(len(valid_waveforms) - pbar.n)
-
-            # Scrivi nel log
-            log_file.write(f"Run {run_count}: {len(valid_waveforms)} valid waveforms accumulated\n")
+            # in feature mode the raw waveforms are only kept for the prescaled sample
+            writer = None
+            if not args.features or args.raw_prescale:
+                writer = outputs.enter_context(chunkwriter(DATA_FILE, roi_length=args.roi))
+            feature_writer = outputs.enter_context(featurewriter(FEATURE_FILE, FEATURE_COLUMNS)) if args.features else None
+            n_accepted = 0
+            n_seen = 0
+
+            if args.pipeline:
+                batches = queue.Queue(maxsize=args.queue_size)
+                stop_event = threading.Event()
+                timing = {"acquire": 0.0, "blocked": 0.0}
+                worker = threading.Thread(target=acquisition_worker,
+                                          args=(session, batches, stop_event, timing, args.sampling, args.quantize, correction),
+                                          daemon=True)
+                worker.start()
+            processing_time = 0.0
+            root_writer = None
+            pedestals = None
+            if args.pedestals and os.path.exists(args.pedestals):
+                pedestals = pedestalaccumulator.load(args.pedestals)
+                print(f"Resuming pedestal maps from {args.pedestals} ({pedestals.count.min()} entries per cell)")
+
+            while n_accepted < min_events:
+                run_count += 1
+                print(f"\nRun {run_count}: Accumulating waveforms... ({n_accepted} / {min_events})")
+                if args.pipeline:
+                    data = batches.get()
+                else:
+                    data = acquire_data(0x0003, correction=correction, session=session,
+                                        sampling=args.sampling, quantize=args.quantize, first_event=n_seen)
+                if data is None:
+                    sys.exit("❌ Acquisition failed.")
+
+                start = time.perf_counter()
+                event_data = handle_data(data, selected_ch=selected_channels)
+                if event_data is None:
+                    sys.exit("❌ No events to process.")
+                raw_data = event_data
+                if calibration is not None:
+                    try:
+                        event_data = calibration.apply(event_data, adc=True)
+                    except ValueError as e:
+                        sys.exit(f"❌ {args.calibration}: {e}")
+                if args.root and root_writer is None:
+                    root_writer = outputs.enter_context(
+                        rootwriter(OUTPUT_FILE, event_data.channels, event_data.record_length, TREE_NAME, args.basket_size,
+                                   dtype=event_data.waveforms.dtype))
+                if args.boards and run_count == 1:
+                    # combined channels are numbered 0..N-1, record the board and channel each one came from
+                    channel_map = [session.channel_map[ch] for ch in event_data.channels]
+                    for ch, (board, board_ch) in zip(event_data.channels, channel_map):
+                        log_file.write(f"Channel {ch}: board {board} channel {board_ch}\n")
+                    for output in (root_writer, feature_writer):
+                        if output is not None:
+                            write_channel_map(output.file, event_data.channels, channel_map)
+
+                if args.filter_ADC is not None:
+                    print(f"🔍 Applying filter: peak-to-peak > {args.filter_ADC} ADC")
+                    mask = filter_batch(event_data.waveforms, threshold=args.filter_ADC)
+                else:
+                    print("No filter applied. Saving all waveforms.")
+                    mask = None
+                accepted = np.ones(event_data.waveforms.shape[:2], dtype=bool) if mask is None else mask
+
+                if feature_writer is not None:
+                    features = extract_features(event_data.waveforms, frequency=args.sampling)
+                    feature_writer.write(feature_table(event_data, features, accepted))
+                    n_accepted = feature_writer.n_rows
+                    if writer is not None:
+                        # raw waveforms of one event every raw_prescale
+                        prescaled = event_data.event_number % args.raw_prescale == 0
+                        writer.write_batch(event_data, accepted & prescaled[:, None])
+                else:
+                    # Append valid waveforms to the output file
+                    writer.write_batch(event_data, accepted)
+                    n_accepted = writer.n_waveforms
+                if root_writer is not None:
+                    # ROOT events keep all channels, an event is accepted if any channel passed
+                    root_writer.write_batch(event_data, accepted.any(axis=1))
+                n_seen += len(event_data)
+                if mask is not None:
+                    print(f"Waveforms after filtering: {n_accepted}")
+
+                if args.pedestals:
+                    if pedestals is None:
+                        pedestals = pedestalaccumulator(raw_data.channels)
+                        if not raw_data.has_first_cell:
+                            print("⚠️ rwave data carries no DRS4 start cell, the pedestal maps are per sample index")
+                    # with a filter only the waveforms without a pulse enter the pedestals
+                    pedestals.accumulate(raw_data, None if mask is None else ~mask, by_sample=True)
+                    if run_count % args.pedestal_save_every == 0:
+                        pedestals.save(args.pedestals)
+                processing_time += time.perf_counter() - start
+
+                # Update barra di avanzamento
+                pbar.update(n_accepted - pbar.n)
+
+                # Scrivi nel log
+                log_file.write(f"Run {run_count}: {n_accepted} valid waveforms accumulated\n")
+
+            if pedestals is not None:
+                pedestals.save(args.pedestals)
+                print(f"Pedestal maps saved in {args.pedestals} ({pedestals.count.min()} entries per cell)")
+            if args.pipeline:
+                # Let the worker finish its current batch so the session ends cleanly
+                stop_event.set()
+                worker.join()
+                # Sequentially the digitizer would sit idle for the whole processing time,
+                # pipelined it only idles while the queue is full
+                recovered = max(0.0, processing_time - timing["blocked"])
+                print(f"⏱️ Pipeline: {timing['acquire']:.2f} s acquiring, {processing_time:.2f} s processing, "
+                      f"{timing['blocked']:.2f} s blocked on a full queue, {recovered:.2f} s of digitizer idle time recovered")
+                log_file.write(f"Pipeline: {recovered:.2f} s of digitizer idle time recovered "
+                               f"({processing_time:.2f} s processing, {timing['blocked']:.2f} s blocked)\n")
         
         # Fine del ciclo
-        print(f"\n{len(valid_waveforms)} valid waveforms accumulated. Saving to NPZ and ROOT.")
-        np.savez_compressed(NPZ_FILE, waveforms=np.array(valid_waveforms))
-        # save_waveforms_to_root({"waveform_ch": valid_waveforms}, OUTPUT_FILE)
+        if feature_writer is not None:
+            print(f"\n{n_accepted} pulse features saved in {FEATURE_FILE}.")
+        if writer is not None:
+            print(f"\n{writer.n_waveforms} valid waveforms accumulated in {DATA_FILE}.")
+        if root_writer is not None:
+            print(f"{root_writer.n_events} events saved in {OUTPUT_FILE} ({TREE_NAME}).")
 
         # Aggiorna il log finale
-        log_file.write(f"Acquisition complete. {len(valid_waveforms)} valid waveforms saved.\n")
+        log_file.write(f"Acquisition complete. {n_accepted} valid waveforms saved to "
+                       f"{FEATURE_FILE if feature_writer is not None else DATA_FILE}.\n")
         pbar.close()
 
     print("Waveforms saved.")
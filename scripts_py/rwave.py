@@ -1,9 +1,59 @@
 #! /usr/bin/env python
 
+import asyncio
 import socket
 import struct
 import numpy as np
 
+ADC_MAX = 4095
+QUANTIZE_BLOCK_EVENTS = 64
+
+
+def quantize_samples(data, out=None):
+    """Round float samples to 12-bit ADC codes stored as uint16."""
+    if out is None:
+        out = np.empty(np.shape(data), dtype=np.uint16)
+    np.clip(np.rint(data), 0, ADC_MAX, out=out, casting='unsafe')
+    return out
+
+
+def quantized_download(n_events, n_channels, record_length, block_events=QUANTIZE_BLOCK_EVENTS):
+    """Plan a download stored as uint16 ADC codes, block_events events at a time.
+
+    Returns the (n_events, n_channels, record_length) uint16 array and a
+    generator of memoryviews, one per block, into a single reused buffer.
+    Each view has to be filled with the raw float32 samples before the next
+    one is requested, the block is then rounded into the array, so the
+    float32 copy of the whole download never exists.
+    """
+    data = np.empty((n_events, n_channels, record_length), dtype=np.uint16)
+    event_size = n_channels * record_length * 4
+
+    def blocks():
+        raw_data = bytearray(min(block_events, n_events) * event_size)
+        for first_event in range(0, n_events, block_events):
+            n_block = min(block_events, n_events - first_event)
+            view = memoryview(raw_data)[:n_block * event_size]
+            yield view
+            block = np.frombuffer(view, dtype='<f4').reshape(n_block, n_channels, record_length)
+            quantize_samples(block, out=data[first_event:first_event + n_block])
+
+    return data, blocks()
+
+
+def config_cmds(config, **settings):
+    """Return the commands needed to go from config to settings, and the settings that changed."""
+    changed = {key: value for key, value in settings.items()
+               if value is not None and config.get(key) != value}
+    cmds = []
+    for key, value in changed.items():
+        if key == 'correction':
+            cmds.append('correction on' if value else 'correction off')
+        else:
+            cmds.append(f'{key} {value}')
+    return cmds, changed
+
+
 class rwaveclient:
 
     def __init__(self, host, port, verbose=True):
@@ -11,6 +61,9 @@ class rwaveclient:
         self.port = port
         self.socket = None
         self.verbose = verbose
+        self.channels = ()
+        self.frequency = None
+        self.rbuf = bytearray()
 
         
     def __print_msg__(self, msg):
@@ -20,6 +73,8 @@ class rwaveclient:
         
     def __enter__(self):
         self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.rbuf = bytearray()
         try:
             self.socket.connect((self.host, self.port))
             self.__print_msg__(f'connected to {self.host}:{self.port}')
@@ -45,63 +100,314 @@ class rwaveclient:
 
         
     def __recv_string__(self):
-        raw_data = b''
+        ### replies are buffered, whatever follows the newline is kept for the next read
         while True:
-            byte = self.socket.recv(1)
-            if not byte:
-                return 'server closed connection'
-            if byte == b'\n':
+            index = self.rbuf.find(b'\n')
+            if index >= 0:
                 break
-            raw_data += byte
+            chunk = self.socket.recv(4096)
+            if not chunk:
+                return 'server closed connection'
+            self.rbuf += chunk
+        raw_data = bytes(self.rbuf[:index])
+        del self.rbuf[:index + 1]
         return raw_data.decode()
 
     
     def send_cmd(self, msg):
+        """Send one bare command (no terminator) and return the newline-terminated reply."""
         if self.socket is None:
             return
         self.socket.sendall(msg.encode())
         message = self.__recv_string__()
         if self.verbose:
             print(f' [SERVER] {message}')
+        return message
+
+    
+    def send_cmds(self, msgs):
+        """Send several commands and return their replies in order.
+
+        The rwave server reads one bare command (no terminator) per recv and
+        has no documented delimiter, so the commands are sent one at a time,
+        each one after the reply to the previous one, exactly like send_cmd.
+        """
+        if self.socket is None:
+            return
+        return [self.send_cmd(msg) for msg in msgs]
 
         
-    def download(self):
+    def __recv_into__(self, view):
+        ### drain what the line reader already buffered before reading the socket
+        received = min(len(self.rbuf), len(view))
+        view[:received] = self.rbuf[:received]
+        del self.rbuf[:received]
+        while received < len(view):
+            n_bytes = self.socket.recv_into(view[received:])
+            if not n_bytes:  # If no data is received, connection is closed
+                raise ConnectionError('server closed the connection')
+            received += n_bytes
+
+            
+    def __recv_header__(self):
         ### receive header
-        raw_data = self.socket.recv(8)
-        if len(raw_data) < 8:
-            raise ValueError('received less than the expected 8 bytes')
+        raw_data = bytearray(8)
+        self.__recv_into__(memoryview(raw_data))
         header = struct.unpack('<HHHH', raw_data)
         n_events, n_channels, record_length, frequency = header
         self.__print_msg__(f'received header: {n_events} events, {n_channels} channels, {record_length} record length, {frequency} MHz sampling')
         ### receive channels
-        raw_data = self.socket.recv(n_channels)
-        if len(raw_data) < n_channels:
-            raise ValueError('received less than the expected {n_channels} bytes')
-        channels = struct.unpack('<' + n_channels * 'B', raw_data)
+        raw_data = bytearray(n_channels)
+        self.__recv_into__(memoryview(raw_data))
+        channels = tuple(raw_data)
         self.__print_msg__(f'received channels: {channels}')
-        ### receive data
-        waveform_size = record_length * 4
-        event_size = n_channels * waveform_size
-        data_size = n_events * event_size
-        raw_data = b''
-        while len(raw_data) < data_size:
-            chunk = self.socket.recv(data_size - len(raw_data))
-            if not chunk:  # If no data is received, connection is closed
+        self.channels = channels
+        self.frequency = frequency
+        return n_events, channels, record_length
+
+    
+    def download_array(self, quantize=False):
+        """Receive a data block as a (n_events, n_channels, record_length) float32 array.
+
+        With quantize the samples are rounded to uint16 ADC codes block by
+        block, so the float32 copy of the whole block never exists.
+        """
+        if quantize:
+            return self.__download_quantized__()
+        n_events, channels, record_length = self.__recv_header__()
+        ### receive data straight into a preallocated buffer
+        data_size = n_events * len(channels) * record_length * 4
+        raw_data = bytearray(data_size)
+        self.__recv_into__(memoryview(raw_data))
+        self.__print_msg__(f'received data: {data_size} bytes')
+        return np.frombuffer(raw_data, dtype='<f4').reshape(n_events, len(channels), record_length)
+
+    
+    def __download_quantized__(self):
+        n_events, channels, record_length = self.__recv_header__()
+        data, blocks = quantized_download(n_events, len(channels), record_length)
+        for view in blocks:
+            self.__recv_into__(view)
+        self.__print_msg__(f'received data: {data.size * 4} bytes, stored as uint16')
+        return data
+
+    
+    def iter_download(self, block_events=64, quantize=False):
+        """Yield (n, n_channels, record_length) blocks of complete events as they arrive.
+
+        Blocks are float32, or with quantize uint16 ADC codes rounded from
+        one reused receive buffer.
+        """
+        n_events, channels, record_length = self.__recv_header__()
+        event_size = len(channels) * record_length * 4
+        raw_data = bytearray(min(block_events, n_events) * event_size) if quantize else None
+        for first_event in range(0, n_events, block_events):
+            n_block = min(block_events, n_events - first_event)
+            view = memoryview(raw_data if quantize else bytearray(n_block * event_size))[:n_block * event_size]
+            self.__recv_into__(view)
+            block = np.frombuffer(view, dtype='<f4').reshape(n_block, len(channels), record_length)
+            yield quantize_samples(block) if quantize else block
+        self.__print_msg__(f'received data: {n_events * event_size} bytes' + (', stored as uint16' if quantize else ''))
+
+    
+    def download(self):
+        """Receive a data block as a list of {channel: waveform} dicts."""
+        data = self.download_array()
+        return [dict(zip(self.channels, event)) for event in data]
+
+
+class rwavesession(rwaveclient):
+    """rwaveclient kept open for a whole run, remembering the configuration already applied."""
+
+    def __init__(self, host, port, verbose=True):
+        super().__init__(host, port, verbose)
+        self.config = {}
+
+        
+    def __enter__(self):
+        self.config = {}
+        return super().__enter__()
+
+    
+    def configure(self, sampling=None, grmask=None, chmask=None, correction=None):
+        """Send only the settings that differ from the last applied ones."""
+        cmds, changed = config_cmds(self.config, sampling=sampling, grmask=grmask, chmask=chmask, correction=correction)
+        if cmds:
+            self.send_cmds(cmds)
+            self.config.update(changed)
+        return cmds
+
+    
+    def acquire(self, n_triggers=1024, quantize=False):
+        """Run one start/swtrg/readout/download cycle and return the data array (uint16 with quantize)."""
+        self.send_cmds(['start', f'swtrg {n_triggers}', 'readout', 'download'])
+        data = self.download_array(quantize)
+        self.send_cmd('stop')
+        return data
+
+    
+    def iter_acquire(self, n_triggers=1024, block_events=64, quantize=False):
+        """Like acquire, but yield event blocks while the download is still running.
+
+        The generator has to be exhausted, otherwise the rest of the block
+        stays on the socket and the session is out of sync.
+        """
+        self.send_cmds(['start', f'swtrg {n_triggers}', 'readout', 'download'])
+        yield from self.iter_download(block_events, quantize)
+        self.send_cmd('stop')
+
+
+
+class asyncrwaveclient:
+    """asyncio version of rwaveclient, so one event loop can drive several servers.
+
+    It uses the event loop socket API on a non-blocking socket instead of
+    asyncio streams, the download payload then goes from the kernel straight
+    into the preallocated buffer with sock_recv_into.
+    """
+
+    def __init__(self, host, port, verbose=True):
+        self.host = host
+        self.port = port
+        self.socket = None
+        self.loop = None
+        self.verbose = verbose
+        self.channels = ()
+        self.frequency = None
+        self.config = {}
+        self.rbuf = bytearray()
+
+        
+    def __print_msg__(self, msg):
+        if self.verbose:
+            print(f' [CLIENT {self.host}:{self.port}] {msg}')
+
+        
+    async def __aenter__(self):
+        self.config = {}
+        self.rbuf = bytearray()
+        self.loop = asyncio.get_running_loop()
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.socket.setblocking(False)
+        try:
+            await self.loop.sock_connect(self.socket, (self.host, self.port))
+            self.__print_msg__(f'connected to {self.host}:{self.port}')
+            await self.send_cmd('model')
+            return self
+        except ConnectionRefusedError:
+            self.__print_msg__(f'failed to connect to {self.host}:{self.port}')
+            self.socket.close()
+            self.socket = None
+            return None
+        except Exception as e:
+            self.__print_msg__(f'connection error to {self.host}:{self.port}: {e}')
+            self.socket.close()
+            self.socket = None
+            return None
+
+        
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        if self.socket:
+            self.socket.close()
+            self.socket = None
+            self.__print_msg__(f'connection to {self.host}:{self.port} closed')
+        if exc_type:
+            self.__print_msg__(f'an exception occurred: {exc_value}')
+        return False
+
+    
+    async def __recv_string__(self):
+        ### replies are buffered, whatever follows the newline is kept for the next read
+        while True:
+            index = self.rbuf.find(b'\n')
+            if index >= 0:
+                break
+            chunk = await self.loop.sock_recv(self.socket, 4096)
+            if not chunk:
+                return 'server closed connection'
+            self.rbuf += chunk
+        raw_data = bytes(self.rbuf[:index])
+        del self.rbuf[:index + 1]
+        return raw_data.decode()
+
+    
+    async def send_cmd(self, msg):
+        """Send one bare command (no terminator) and return the newline-terminated reply."""
+        if self.socket is None:
+            return
+        await self.loop.sock_sendall(self.socket, msg.encode())
+        message = await self.__recv_string__()
+        if self.verbose:
+            print(f' [SERVER {self.host}:{self.port}] {message}')
+        return message
+
+    
+    async def send_cmds(self, msgs):
+        """Send several commands one at a time and return their replies, same framing as rwaveclient.send_cmds."""
+        if self.socket is None:
+            return
+        return [await self.send_cmd(msg) for msg in msgs]
+
+    
+    async def __recv_into__(self, view):
+        ### drain what the line reader already buffered before reading the socket
+        received = min(len(self.rbuf), len(view))
+        view[:received] = self.rbuf[:received]
+        del self.rbuf[:received]
+        while received < len(view):
+            n_bytes = await self.loop.sock_recv_into(self.socket, view[received:])
+            if not n_bytes:  # If no data is received, connection is closed
                 raise ConnectionError('server closed the connection')
-            raw_data += chunk
+            received += n_bytes
+
+            
+    async def __recv_header__(self):
+        ### receive header
+        raw_data = bytearray(8)
+        await self.__recv_into__(memoryview(raw_data))
+        header = struct.unpack('<HHHH', raw_data)
+        n_events, n_channels, record_length, frequency = header
+        self.__print_msg__(f'received header: {n_events} events, {n_channels} channels, {record_length} record length, {frequency} MHz sampling')
+        ### receive channels
+        raw_data = bytearray(n_channels)
+        await self.__recv_into__(memoryview(raw_data))
+        channels = tuple(raw_data)
+        self.__print_msg__(f'received channels: {channels}')
+        self.channels = channels
+        self.frequency = frequency
+        return n_events, channels, record_length
+
+    
+    async def download_array(self, quantize=False):
+        """Receive a data block as a (n_events, n_channels, record_length) float32 array, uint16 with quantize."""
+        n_events, channels, record_length = await self.__recv_header__()
+        if quantize:
+            data, blocks = quantized_download(n_events, len(channels), record_length)
+            for view in blocks:
+                await self.__recv_into__(view)
+            self.__print_msg__(f'received data: {data.size * 4} bytes, stored as uint16')
+            return data
+        ### receive data straight into a preallocated buffer
+        data_size = n_events * len(channels) * record_length * 4
+        raw_data = bytearray(data_size)
+        await self.__recv_into__(memoryview(raw_data))
         self.__print_msg__(f'received data: {data_size} bytes')
-        ### unpack data 
-        self.__print_msg__('unpacking data')
-        waveform_fmt = '<' + record_length * 'f'
-        waveform_struct = struct.Struct(waveform_fmt)  # Precompile for efficiency
-        index = 0
-        data = []
-        for event in range(n_events):
-            event_data = {}
-            for channel in channels:
-                unpacked = waveform_struct.unpack(raw_data[index:index + waveform_size])
-                index += waveform_size
-                waveform_data = np.array(unpacked, dtype = float)
-                event_data[channel] = waveform_data
-            data.append(event_data)
+        return np.frombuffer(raw_data, dtype='<f4').reshape(n_events, len(channels), record_length)
+
+    
+    async def configure(self, sampling=None, grmask=None, chmask=None, correction=None):
+        """Send only the settings that differ from the last applied ones."""
+        cmds, changed = config_cmds(self.config, sampling=sampling, grmask=grmask, chmask=chmask, correction=correction)
+        if cmds:
+            await self.send_cmds(cmds)
+            self.config.update(changed)
+        return cmds
+
+    
+    async def acquire(self, n_triggers=1024, quantize=False):
+        """Run one start/swtrg/readout/download cycle and return the data array (uint16 with quantize)."""
+        await self.send_cmds(['start', f'swtrg {n_triggers}', 'readout', 'download'])
+        data = await self.download_array(quantize)
+        await self.send_cmd('stop')
         return data
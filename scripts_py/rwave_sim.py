@@ -0,0 +1,165 @@
+#! /usr/bin/env python
+
+import argparse
+import socketserver
+import struct
+import time
+import numpy as np
+
+### rwave server simulator: speaks the same protocol as rwaveserver on port 30001
+### (one bare command per recv, one reply line per command, then <HHHH header, channel bytes and float32 data on download)
+
+parser = argparse.ArgumentParser(description="Local rwave server simulator for load and soak testing.")
+parser.add_argument("--host", type=str, default="localhost", help="Address to listen on (default: localhost).")
+parser.add_argument("--port", type=int, default=30001, help="Port to listen on (default: 30001).")
+parser.add_argument("--record_length", type=int, default=1024, help="Samples per waveform (default: 1024).")
+parser.add_argument("--chmask", type=lambda x: int(x, 0), default=0x3, help="Initial channel mask (default: 0x3).")
+parser.add_argument("--rate", type=float, default=None,
+                    help="Trigger rate in Hz, swtrg N then takes N/rate seconds (default: no limit).")
+parser.add_argument("--pulse_fraction", type=float, default=0.5, help="Fraction of waveforms with a pulse (default: 0.5).")
+parser.add_argument("--gain", type=float, default=15.0, help="ADC counts per photoelectron (default: 15).")
+parser.add_argument("--mean_npe", type=float, default=3.0, help="Mean number of photoelectrons per pulse (default: 3).")
+parser.add_argument("--noise", type=float, default=2.0, help="Gaussian noise RMS in ADC counts (default: 2).")
+parser.add_argument("--baseline", type=float, default=2048.0, help="Baseline in ADC counts (default: 2048).")
+parser.add_argument("--latency", type=float, default=0.0, help="Delay before every reply, in seconds (default: 0).")
+parser.add_argument("--bandwidth", type=float, default=None, help="Download bandwidth limit in MB/s (default: no limit).")
+parser.add_argument("--drop_prob", type=float, default=0.0,
+                    help="Probability to drop the connection on a command, mid-transfer for downloads (default: 0).")
+parser.add_argument("--seed", type=int, default=None, help="Random seed.")
+
+
+def generate_waveforms(rng, n_events, n_channels, record_length, frequency, args):
+    """Return (n_events, n_channels, record_length) float32 SiPM-like waveforms."""
+    shape = (n_events, n_channels)
+    data = rng.normal(args.baseline, args.noise, size=shape + (record_length,)).astype(np.float32)
+
+    # negative pulses: difference of exponentials, rise ~1 ns and fall ~20 ns at the given sampling
+    samples_per_ns = frequency / 1000.0
+    t = np.arange(record_length) / samples_per_ns
+    t0 = rng.normal(record_length / samples_per_ns / 2, 2.0, size=shape)[..., None]
+    dt = np.clip(t - t0, 0, None)
+    pulse = np.exp(-dt / 20.0) - np.exp(-dt / 1.0)
+    pulse /= pulse.max(axis=-1, keepdims=True).clip(1e-12)
+
+    npe = rng.poisson(args.mean_npe, size=shape) * (rng.random(shape) < args.pulse_fraction)
+    data -= (npe * args.gain)[..., None] * pulse
+    return data
+
+
+class rwavesimhandler(socketserver.BaseRequestHandler):
+
+    def setup(self):
+        self.args = self.server.args
+        self.rng = np.random.default_rng(self.args.seed)
+        self.frequency = 5000
+        self.chmask = self.args.chmask
+        self.data = None
+        self.running = False
+
+
+    def reply(self, message):
+        if self.args.latency:
+            time.sleep(self.args.latency)
+        self.request.sendall(f'{message}\n'.encode())
+
+
+    def send_throttled(self, payload):
+        if not self.args.bandwidth:
+            self.request.sendall(payload)
+            return
+        chunk_size = 1 << 16
+        bytes_per_second = self.args.bandwidth * 1e6
+        start = time.perf_counter()
+        for offset in range(0, len(payload), chunk_size):
+            self.request.sendall(payload[offset:offset + chunk_size])
+            ahead = (offset + chunk_size) / bytes_per_second - (time.perf_counter() - start)
+            if ahead > 0:
+                time.sleep(ahead)
+
+
+    def handle(self):
+        peer = self.client_address
+        print(f' [SIM] connection from {peer[0]}:{peer[1]}')
+        while True:
+            chunk = self.request.recv(4096)
+            if not chunk:
+                break
+            ### like rwaveserver: every recv is one bare command, there is no delimiter
+            cmd = chunk.decode().strip()
+            if not cmd:
+                continue
+            if self.rng.random() < self.args.drop_prob:
+                print(f' [SIM] dropping connection on "{cmd}"')
+                if cmd == 'download' and self.data is not None:
+                    self.reply('download')
+                    self.request.sendall(self.payload()[:self.data.nbytes // 2])
+                return
+            self.execute(cmd)
+        print(f' [SIM] connection from {peer[0]}:{peer[1]} closed')
+
+
+    def channels(self):
+        return [ch for ch in range(16) if self.chmask >> ch & 1]
+
+
+    def payload(self):
+        n_events, n_channels, record_length = self.data.shape
+        header = struct.pack('<HHHH', n_events, n_channels, record_length, self.frequency)
+        return header + bytes(self.channels()) + self.data.astype('<f4').tobytes()
+
+
+    def execute(self, cmd):
+        name, _, value = cmd.partition(' ')
+        if name == 'model':
+            self.reply('DT5742 (rwave simulator)')
+        elif name == 'sampling':
+            self.frequency = int(float(value))
+            self.reply(f'sampling {self.frequency} MHz')
+        elif name == 'chmask':
+            self.chmask = int(value, 0)
+            self.reply(f'chmask {self.chmask:#06x}')
+        elif name in ('grmask', 'correction'):
+            self.reply(f'{name} {value}')
+        elif name == 'start':
+            self.running = True
+            self.reply('acquisition started')
+        elif name == 'stop':
+            self.running = False
+            self.reply('acquisition stopped')
+        elif name == 'swtrg':
+            n_events = int(value) if value else 1
+            if self.args.rate:
+                time.sleep(n_events / self.args.rate)
+            self.data = generate_waveforms(self.rng, n_events, len(self.channels()),
+                                           self.args.record_length, self.frequency, self.args)
+            self.reply(f'{n_events} software triggers sent')
+        elif name == 'readout':
+            n_events = 0 if self.data is None else len(self.data)
+            self.reply(f'{n_events} events read out')
+        elif name == 'download':
+            if self.data is None:
+                self.data = np.zeros((0, len(self.channels()), self.args.record_length), dtype=np.float32)
+            self.reply('download')
+            self.send_throttled(self.payload())
+            self.data = None
+        else:
+            self.reply(f'unknown command: {cmd}')
+
+
+class rwavesimserver(socketserver.ThreadingTCPServer):
+    allow_reuse_address = True
+    daemon_threads = True
+
+    def __init__(self, address, args):
+        self.args = args
+        super().__init__(address, rwavesimhandler)
+
+
+if __name__ == "__main__":
+    args = parser.parse_args()
+    with rwavesimserver((args.host, args.port), args) as server:
+        print(f' [SIM] rwave simulator listening on {args.host}:{args.port}')
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
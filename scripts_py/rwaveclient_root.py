@@ -2,13 +2,14 @@ import sys
 import numpy as np
 import argparse
 import matplotlib.pyplot as plt
-import uproot
 from tqdm import tqdm  # Barra di avanzamento
 from datetime import datetime
 import os
 
 sys.path.append("/eu/caen-dt5742b/python/")
-from rwave import rwaveclient
+from rwave import rwavesession
+from eventbatch import eventbatch, filter_batch
+from waveform_io import rootwriter
 
 parser = argparse.ArgumentParser(description="Receive and save waveform data from CAEN digitizer.")
 parser.add_argument("--filter_ADC", type=float, default=None,
@@ -19,90 +20,47 @@ parser.add_argument("--min_events", type=int, default=1000,
                     help="Minimum number of valid waveforms to accumulate before saving.")
 parser.add_argument("--log_file", type=str, default="acquisition_log.txt", 
                     help="Log file to record acquisition details.")
-args = parser.parse_args()
-
-
-# Create data directory if it doesn't exist
-os.makedirs("./data", exist_ok=True)
 
 HOST = 'localhost'
 PORT = 30001
-
-timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-OUTPUT_FILE = f"./data/{timestamp}_waveforms.root"
-NPZ_FILE = f"./data/{timestamp}_waveforms.npz"
 TREE_NAME = "waveform_tree"
 
 
 
-def acquire_data(chmask, correction):
-    """Acquire waveform data from the digitizer."""
-    with rwaveclient(HOST, PORT, verbose=True) as rwc:
-        if rwc is None:
-            return None
+def acquire_data(chmask, correction=True, session=None, first_event=0):
+    """Acquire waveform data from the digitizer, reusing an open session if given.
 
-        rwc.send_cmd('sampling 5000')
-        rwc.send_cmd('grmask 0x1')
-        rwc.send_cmd(f'chmask {chmask}')
-        rwc.send_cmd('correction on' if correction else 'correction off')
-        rwc.send_cmd("start")
-        rwc.send_cmd('swtrg 1024')
-        rwc.send_cmd('readout')
-        rwc.send_cmd('download')
-        data = rwc.download()
-        rwc.send_cmd('stop')
+    Events are numbered from first_event, so numbers keep increasing over a run.
+    """
+    if session is None:
+        with rwavesession(HOST, PORT, verbose=True) as session:
+            if session is None:
+                return None
+            return acquire_data(chmask, correction, session, first_event)
 
-        return data
+    session.configure(sampling=5000, grmask='0x1', chmask=chmask, correction=correction)
+    data = session.acquire(1024)
+    return eventbatch(data, session.channels, event_number=first_event + np.arange(len(data)))
 
 
 def handle_data(data, selected_ch=None):
-    """Process waveform data and return one dictionary per event."""
+    """Return the acquired events as an eventbatch restricted to the selected channels."""
     if data is None:
         print("No data received.")
         return None
 
-    all_events_data = []
-    max_channels = len(data[0])
-
+    if not isinstance(data, eventbatch):
+        data = eventbatch.from_events(data)
     if selected_ch is not None:
-        active_channels = selected_ch
-    else:
-        active_channels = range(max_channels)
-
-    for event_number, event in enumerate(data):
-        for ch in active_channels:
-            waveform = event[ch]["waveform"]
-            tree_data = {
-                "event_number": np.array([event_number]),
-                f'waveform_ch{ch}': np.array([waveform]),
-                "trigger_tag": np.array([event[0]["trigger_tag"]]),
-                "first_cell": np.array([event[0]["first_cell"]]),
-                "num_cells": np.array([np.arange(len(waveform))])
-            }
-            all_events_data.append(tree_data)
-
-    return all_events_data
+        data = data.select_channels(selected_ch)
+    return data
 
 
 def apply_filter(event_data, threshold=20, window_size=900):
-    """Filter waveform events based on central peak-to-peak amplitude."""
-    start_idx = (1024 - window_size) // 2
-    end_idx = start_idx + window_size
-    filtered_dict = {}
-
-    for event in event_data:
-        for key in event:
-            if key.startswith("waveform_ch"):
-                ch = key.split("waveform_ch")[1]
-                wf = event[key].squeeze()
-                central_window = wf[start_idx:end_idx]
-                peak_to_peak = central_window.max() - central_window.min()
-                if peak_to_peak > threshold:
-                    if f'waveform_ch{ch}' not in filtered_dict:
-                        filtered_dict[f'waveform_ch{ch}'] = []
-                    filtered_dict[f'waveform_ch{ch}'].append(wf)
-
-    return filtered_dict
+    """Filter waveforms based on central peak-to-peak amplitude, grouped per channel."""
+    mask = filter_batch(event_data.waveforms, threshold, window_size)
+    return {f'waveform_ch{ch}': event_data.waveforms[mask[:, i], i]
+            for i, ch in enumerate(event_data.channels) if mask[:, i].any()}
 
 
 def save_filtered_waveforms_to_npz(filtered_dict, output_file):
@@ -117,23 +75,27 @@ def save_filtered_waveforms_to_npz(filtered_dict, output_file):
     return bool(filtered_dict)
 
 
-def save_waveforms_to_root(filtered_dict, output_file):
-    """Save filtered waveforms into separate ROOT files per channel."""
+def save_waveforms_to_root(filtered_dict, output_file, basket_size=1024):
+    """Save filtered waveforms into one waveform_tree per channel file."""
+    directory, name = os.path.split(output_file)
     for ch_key, waveforms in filtered_dict.items():
-        ch = ch_key.replace("waveform_ch", "")
-        with uproot.recreate(f'ch{ch}_{output_file}') as file:
-            for i, wf in enumerate(waveforms):
-                file[f"{TREE_NAME}_event_{i}"] = {
-                    "event_number": np.array([i]),
-                    f"waveform_ch{ch}": np.array([wf]),
-                    "trigger_tag": np.array([0]),
-                    "first_cell": np.array([0]),
-                    "num_cells": np.array([np.arange(len(wf))])
-                }
-        print(f"ROOT file saved: ch{ch}_{output_file}")
-
+        ch = int(ch_key.replace("waveform_ch", ""))
+        waveforms = np.asarray(waveforms)
+        ch_file = os.path.join(directory, f'ch{ch}_{name}')
+        with rootwriter(ch_file, [ch], waveforms.shape[-1], TREE_NAME, basket_size) as writer:
+            writer.write_batch(eventbatch(waveforms[:, None], [ch]))
+        print(f"ROOT file saved: {ch_file}")
 
 if __name__ == "__main__":
+    args = parser.parse_args()
+
+    # Create data directory if it doesn't exist
+    os.makedirs("./data", exist_ok=True)
+
+    timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
+    OUTPUT_FILE = f"./data/{timestamp}_waveforms.root"
+    NPZ_FILE = f"./data/{timestamp}_waveforms.npz"
+
     selected_channels = args.channel if args.channel else None
     print(f"Selected channels: {selected_channels}")
 
@@ -143,6 +105,7 @@ if __name__ == "__main__":
     # Initialize list to store valid waveforms
     valid_waveforms = []
     run_count = 0
+    n_acquired = 0
 
     # Open log file
     with open(args.log_file, 'w') as log_file:
@@ -152,38 +115,41 @@ if __name__ == "__main__":
         # Barra di avanzamento
         pbar = tqdm(total=min_events, desc="Accumulating waveforms", ncols=100, unit="waveforms")
 
-        while len(valid_waveforms) < min_events:
-            run_count += 1
-            print(f"\nRun {run_count}: Accumulating waveforms... ({len(valid_waveforms)} / {min_events})")
-            data = acquire_data(0x0003, correction=True)
-            if data is None:
+        # One connection for the whole run, settings are sent only when they change
+        with rwavesession(HOST, PORT, verbose=True) as session:
+            if session is None:
                 sys.exit("❌ Acquisition failed.")
 
-            event_data = handle_data(data, selected_ch=selected_channels)
-            if event_data is None:
-                sys.exit("❌ No events to process.")
+            while len(valid_waveforms) < min_events:
+                run_count += 1
+                print(f"\nRun {run_count}: Accumulating waveforms... ({len(valid_waveforms)} / {min_events})")
+                data = acquire_data(0x0003, correction=True, session=session, first_event=n_acquired)
+                if data is None:
+                    sys.exit("❌ Acquisition failed.")
+                n_acquired += len(data)
+
+                event_data = handle_data(data, selected_ch=selected_channels)
+                if event_data is None:
+                    sys.exit("❌ No events to process.")
 
-            if args.filter_ADC is not None:
-                print(f"🔍 Applying filter: peak-to-peak > {args.filter_ADC} ADC")
-                filtered = apply_filter(event_data, threshold=args.filter_ADC)
+                if args.filter_ADC is not None:
+                    print(f"🔍 Applying filter: peak-to-peak > {args.filter_ADC} ADC")
+                    filtered = apply_filter(event_data, threshold=args.filter_ADC)
 
-                # Append valid waveforms to the list
-                for ch_key, waveforms in filtered.items():
-                    valid_waveforms.extend(waveforms)
+                    # Append valid waveforms to the list
+                    for ch_key, waveforms in filtered.items():
+                        valid_waveforms.extend(waveforms)
 
-                print(f"Waveforms after filtering: {len(valid_waveforms)}")
-            else:
-                print("No filter applied. Saving all waveforms.")
-                for event in event_data:
-                    for ch_key in event:
-                        if ch_key.startswith("waveform_ch"):
-                            valid_waveforms.append(event[ch_key])
+                    print(f"Waveforms after filtering: {len(valid_waveforms)}")
+                else:
+                    print("No filter applied. Saving all waveforms.")
+                    valid_waveforms.extend(event_data.waveforms.reshape(-1, event_data.record_length))
 
-            # Update barra di avanzamento
-            pbar.update(len(valid_waveforms) - pbar.n)
+                # Update barra di avanzamento
+                pbar.update(len(valid_waveforms) - pbar.n)
 
-            # Scrivi nel log
-            log_file.write(f"Run {run_count}: {len(valid_waveforms)} valid waveforms accumulated\n")
+                # Scrivi nel log
+                log_file.write(f"Run {run_count}: {len(valid_waveforms)} valid waveforms accumulated\n")
         
         # Fine del ciclo
         print(f"\n{len(valid_waveforms)} valid waveforms accumulated. Saving to NPZ and ROOT.")
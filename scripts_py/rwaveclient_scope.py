@@ -9,6 +9,7 @@ from matplotlib.backends.backend_qt5agg import FigureCanvasQTAgg as FigureCanvas
 from matplotlib.backends.backend_qt5agg import NavigationToolbar2QT
 sys.path.append("/eu/caen-dt5742b/python/")
 from rwave import rwaveclient
+from eventbatch import eventbatch
 
 host = 'localhost'
 port = 30001
@@ -38,10 +39,12 @@ class OscilloscopeApp(QWidget):
     def configure_digitizer(self):
         with rwaveclient(self.host, self.port, verbose=True) as rwc:
             if rwc is not None:
-                rwc.send_cmd(f'sampling {self.current_frequency}')
-                rwc.send_cmd('grmask 0x1')
-                rwc.send_cmd('chmask 0x0003')
-                rwc.send_cmd('correction on' if self.correction_enabled else 'correction off')
+                rwc.send_cmds([
+                    f'sampling {self.current_frequency}',
+                    'grmask 0x1',
+                    'chmask 0x0003',
+                    'correction on' if self.correction_enabled else 'correction off',
+                ])
     
     def toggle_channel(self, ch, state):
         self.channel_visibility[ch] = state == Qt.Checked
@@ -117,11 +120,8 @@ class OscilloscopeApp(QWidget):
         with rwaveclient(self.host, self.port, verbose=True) as rwc:
             if rwc is None:
                 return None
-            rwc.send_cmd("start")
-            rwc.send_cmd('swtrg 1024')
-            rwc.send_cmd('readout')
-            rwc.send_cmd('download')
-            data = rwc.download()
+            rwc.send_cmds(['start', 'swtrg 1024', 'readout', 'download'])
+            data = eventbatch(rwc.download_array(), rwc.channels)
             rwc.send_cmd('stop')
         return data
     
@@ -159,10 +159,9 @@ class OscilloscopeApp(QWidget):
     
     def update_plot(self, frame):
         if self.latest_data is not None:
-            event = self.latest_data[self.current_frame]
             for ch in [0, 1]:
-                if self.channel_visibility[ch]:
-                    self.lines[ch].set_ydata(event[ch]["waveform"])
+                if self.channel_visibility[ch] and ch in self.latest_data.channels:
+                    self.lines[ch].set_ydata(self.latest_data.channel(ch)[self.current_frame])
             self.ax.set_title(f'Frame {self.current_frame}', color='white')
             self.current_frame = (self.current_frame + 1) % len(self.latest_data)
             self.canvas.flush_events()
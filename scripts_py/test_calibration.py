@@ -0,0 +1,103 @@
+import numpy as np
+import pytest
+from scipy.stats import linregress
+
+from eventbatch import eventbatch
+from calibration_utils import calibrationstats, calibrator, pedestalaccumulator, cell_indices
+
+N_CELLS = 16
+RECORD_LENGTH = 16
+
+
+def cell_batch(values, first_cell):
+    """Batch whose sample of cell c holds values[..., c], for the given start cells."""
+    cells = cell_indices(first_cell, RECORD_LENGTH, N_CELLS)
+    waveforms = np.take_along_axis(values, cells[:, None, :], axis=-1)
+    return eventbatch(waveforms, (0, 1), first_cell=first_cell)
+
+
+def test_calibration_fit_matches_linregress():
+    rng = np.random.default_rng(0)
+    slope = rng.uniform(3000, 5000, (2, N_CELLS))
+    intercept = rng.uniform(1800, 2200, (2, N_CELLS))
+    voltages = [-0.4, -0.2, 0.0, 0.2, 0.4]
+    stats = calibrationstats((0, 1), n_cells=N_CELLS)
+    for v in voltages:
+        for _ in range(3):
+            n_events = 50
+            values = intercept + slope * v + rng.normal(0, 1, (n_events, 2, N_CELLS))
+            stats.accumulate(cell_batch(values, rng.integers(0, N_CELLS, n_events)), v)
+
+    fit = stats.fit()
+    mean, _ = stats.moments()
+    reference = linregress(stats.voltages, mean[:, 1, 5])
+    assert fit['slope'][1, 5] == pytest.approx(reference.slope)
+    assert fit['intercept'][1, 5] == pytest.approx(reference.intercept)
+    assert fit['r_value'][1, 5] == pytest.approx(reference.rvalue)
+    assert fit['std_err'][1, 5] == pytest.approx(reference.stderr)
+    np.testing.assert_allclose(fit['slope'], slope, rtol=1e-3)
+
+    # applying the fitted calibration gives the voltage back
+    correction = calibrator((0, 1), fit['slope'], fit['intercept'])
+    first_cell = np.arange(4)
+    data = cell_batch(np.broadcast_to(intercept + slope * 0.1, (4, 2, N_CELLS)), first_cell)
+    np.testing.assert_allclose(correction.apply(data).waveforms, 0.1, atol=1e-3)
+
+
+def test_calibration_checks_start_cells_against_the_table(tmp_path):
+    no_cells = eventbatch(np.ones((3, 2, RECORD_LENGTH), dtype=np.float32))
+    with_cells = eventbatch(np.ones((3, 2, RECORD_LENGTH), dtype=np.float32), first_cell=np.arange(3))
+
+    per_cell = calibrator((0, 1), np.ones((2, N_CELLS)), np.zeros((2, N_CELLS)))
+    with pytest.raises(ValueError):
+        per_cell.apply(no_cells)
+    np.testing.assert_array_equal(per_cell.apply(with_cells).waveforms, 1.0)
+
+    # the by_sample flag survives the file
+    path = str(tmp_path / 'calibration.npz')
+    calibrator((0, 1), np.ones((2, N_CELLS)), np.zeros((2, N_CELLS)), by_sample=True).save(path)
+    per_sample = calibrator.load(path)
+    assert per_sample.by_sample
+    with pytest.raises(ValueError):
+        per_sample.apply(with_cells)
+    np.testing.assert_array_equal(per_sample.apply(no_cells).waveforms, 1.0)
+
+    stats = calibrationstats((0, 1), n_cells=N_CELLS)
+    with pytest.raises(ValueError):
+        stats.accumulate(no_cells, 0.0)
+    calibrationstats((0, 1), n_cells=N_CELLS, by_sample=True).accumulate(no_cells, 0.0)
+
+
+def test_welford_merge_matches_direct_statistics(tmp_path):
+    rng = np.random.default_rng(1)
+    values = rng.normal(2000, 3, (300, 2, N_CELLS))
+    first_cell = rng.integers(0, N_CELLS, len(values))
+    mask = rng.random((len(values), 2)) > 0.2
+
+    pedestals = pedestalaccumulator((0, 1), n_cells=N_CELLS)
+    for start in range(0, 160, 40):
+        batch = cell_batch(values[start:start + 40], first_cell[start:start + 40])
+        pedestals.accumulate(batch, mask[start:start + 40])
+
+    # state saved half way and resumed
+    path = str(tmp_path / 'pedestals.npz')
+    pedestals.save(path)
+    pedestals = pedestalaccumulator.load(path)
+    for start in range(160, 300, 70):
+        batch = cell_batch(values[start:start + 70], first_cell[start:start + 70])
+        pedestals.accumulate(batch, mask[start:start + 70])
+
+    for c in range(2):
+        keep = mask[:, c]
+        np.testing.assert_array_equal(pedestals.count[c], keep.sum())
+        np.testing.assert_allclose(pedestals.pedestal[c], values[keep, c].mean(axis=0))
+        np.testing.assert_allclose(pedestals.m2[c], values[keep, c].var(axis=0) * keep.sum())
+
+
+def test_pedestals_refuse_batches_without_first_cell():
+    pedestals = pedestalaccumulator((0, 1), n_cells=N_CELLS)
+    data = eventbatch(np.ones((3, 2, RECORD_LENGTH), dtype=np.float32))
+    with pytest.raises(ValueError):
+        pedestals.accumulate(data)
+    pedestals.accumulate(data, by_sample=True)
+    np.testing.assert_array_equal(pedestals.count, 3)
@@ -0,0 +1,96 @@
+import numpy as np
+
+from eventbatch import eventbatch
+from waveform_io import chunkwriter, chunkreader, find_roi, extract_roi, expand_roi, ROI_META_DTYPE
+
+
+def make_batch(n_events=8, channels=(0, 1), record_length=64, first_event=0, seed=0):
+    rng = np.random.default_rng(seed)
+    waveforms = rng.normal(2000, 2, (n_events, len(channels), record_length)).astype(np.float32)
+    return eventbatch(waveforms, channels, first_event + np.arange(n_events),
+                      trigger_tag=np.arange(n_events) * 10, first_cell=np.arange(n_events) % 1024)
+
+
+def write_file(path, batches, **kwargs):
+    with chunkwriter(path, fsync=False, **kwargs) as writer:
+        for batch in batches:
+            writer.write_batch(batch)
+
+
+def test_index_and_trailer(tmp_path):
+    path = str(tmp_path / 'run.wfc')
+    batches = [make_batch(first_event=0, seed=1), make_batch(n_events=5, first_event=8, seed=2)]
+    write_file(path, batches)
+
+    with chunkreader(path) as reader:
+        assert reader.complete
+        assert reader.n_chunks == 2
+        assert len(reader) == 2 * (8 + 5)
+        assert list(reader.index['n_waveforms']) == [16, 10]
+        np.testing.assert_array_equal(reader['waveforms'],
+                                      np.concatenate([b.waveforms.reshape(-1, 64) for b in batches]))
+        np.testing.assert_array_equal(reader['event_number'], np.repeat(np.arange(13), 2))
+        np.testing.assert_array_equal(reader['channel'], np.tile([0, 1], 13))
+
+
+def test_scan_recovers_interrupted_file(tmp_path):
+    path = str(tmp_path / 'run.wfc')
+    batches = [make_batch(first_event=8 * i, seed=i) for i in range(3)]
+    write_file(path, batches)
+    with chunkreader(path) as reader:
+        last_chunk = int(reader.index['offset'][-1])
+
+    # no trailer and a last chunk cut in the middle, as left by a killed run
+    with open(path, 'r+b') as f:
+        f.truncate(last_chunk + 100)
+
+    with chunkreader(path) as reader:
+        assert not reader.complete
+        assert reader.n_chunks == 2
+        np.testing.assert_array_equal(reader['waveforms'],
+                                      np.concatenate([b.waveforms.reshape(-1, 64) for b in batches[:2]]))
+        np.testing.assert_array_equal(reader['event_number'], np.repeat(np.arange(16), 2))
+
+
+def test_plot_first_waveform_skips_non_waveform_keys(tmp_path, monkeypatch):
+    import matplotlib
+    matplotlib.use('Agg')
+    import matplotlib.pyplot as plt
+    import plot_wf
+
+    path = str(tmp_path / 'roi.wfc')
+    write_file(path, [make_batch(record_length=128)], roi_length=80)
+    monkeypatch.setattr(plt, 'show', lambda: None)
+    with plot_wf.load_waveforms(path) as data:
+        plot_wf.plot_first_waveform(data)
+    assert [line.get_label() for line in plt.gca().get_lines()] == ['waveforms']
+    plt.close('all')
+
+
+def test_roi_expand_round_trip():
+    record_length, roi_length = 200, 40
+    waveforms = np.full((3, record_length), 2000.0, dtype=np.float32)
+    for i, peak in enumerate([10, 100, 195]):
+        waveforms[i, peak] -= 300
+
+    offsets, baselines = find_roi(waveforms, roi_length, pre_samples=15)
+    segments = extract_roi(waveforms, offsets, roi_length)
+    meta = np.zeros(len(waveforms), dtype=ROI_META_DTYPE)
+    meta['offset'], meta['record_length'], meta['baseline'] = offsets, record_length, baselines
+
+    assert list(offsets) == [0, 85, record_length - roi_length]
+    np.testing.assert_array_equal(expand_roi(segments, meta), waveforms)
+
+
+def test_zero_suppressed_file_reads_back_full_records(tmp_path):
+    path = str(tmp_path / 'roi.wfc')
+    batch = make_batch(record_length=128)
+    batch.waveforms[:, :, 60] -= 500
+    write_file(path, [batch], roi_length=80)
+
+    with chunkreader(path) as reader:
+        assert reader.zero_suppressed
+        assert reader['roi'].shape == (16, 80)
+        full = reader['waveforms']
+    assert full.shape == (16, 128)
+    np.testing.assert_array_equal(full[:, 60], batch.waveforms[:, :, 60].reshape(-1))
@@ -0,0 +1,167 @@
+#! /usr/bin/env python
+
+import argparse
+import itertools
+import os
+import re
+import sys
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+from functools import reduce
+import numpy as np
+
+from eventbatch import eventbatch
+from waveform_io import chunkwriter, rootwriter, wavedumpreader, META_DTYPE
+
+### convert the per-channel WaveDump x742 output (wave_N / TR_x_y, binary or ASCII)
+### into the project's chunked .wfc or ROOT waveform_tree format.
+### ASCII files are parsed in parallel into temporary .npy files, binary files are
+### memory mapped directly, then channels are aligned by event counter and written in chunks.
+
+parser = argparse.ArgumentParser(description="Convert WaveDump x742 output files to .wfc or ROOT.")
+parser.add_argument("input_dir", type=str, help="Directory containing the WaveDump wave_N/TR_x_y files.")
+parser.add_argument("--output", type=str, required=True, help="Output file, .wfc or .root.")
+parser.add_argument("--workers", type=int, default=os.cpu_count(), help="Processes used to parse ASCII files (default: all CPUs).")
+parser.add_argument("--chunk_events", type=int, default=1024, help="Events written per chunk/basket (default: 1024).")
+parser.add_argument("--no_header", action="store_true", help="Files were written with OUTPUT_FILE_HEADER NO.")
+parser.add_argument("--record_length", type=int, default=None, help="Samples per record, required with --no_header.")
+
+FILE_PATTERN = re.compile(r'^(?:wave_(\d+)|TR_(\d)_(\d))\.(dat|txt)$')
+ASCII_HEADER_LINES = 8
+ASCII_BLOCK_RECORDS = 256
+EVENT_COUNTER_BITS = 24  # width of the event counter in the CAEN event header
+
+
+def find_wavedump_files(directory):
+    """Return {channel: path} for the WaveDump files in directory, TR_g_i mapped to channel 32 + 2*g + i."""
+    files = {}
+    for name in sorted(os.listdir(directory)):
+        match = FILE_PATTERN.match(name)
+        if match is None:
+            continue
+        wave, group, index = match.group(1), match.group(2), match.group(3)
+        channel = int(wave) if wave is not None else 32 + 2 * int(group) + int(index)
+        files[channel] = os.path.join(directory, name)
+    return files
+
+
+def parse_ascii_file(path, output_prefix, header=True, record_length=None, block_records=ASCII_BLOCK_RECORDS):
+    """Parse a WaveDump ASCII file into <output_prefix>.npy (waveforms) and <output_prefix>_meta.npy.
+
+    Records are read block_records at a time into memory-mapped outputs,
+    so a worker holds one block of text, never the whole file.
+    """
+    with open(path) as f:
+        if header:
+            record_length = int(f.readline().split(':')[1])
+        n_header = ASCII_HEADER_LINES if header else 0
+        n_lines = n_header + record_length
+        f.seek(0)
+        n_records = sum(1 for _ in f) // n_lines
+        f.seek(0)
+        waveforms = np.lib.format.open_memmap(f'{output_prefix}.npy', mode='w+', dtype=np.float32,
+                                              shape=(n_records, record_length))
+        meta = np.lib.format.open_memmap(f'{output_prefix}_meta.npy', mode='w+', dtype=META_DTYPE, shape=(n_records,))
+        for start in range(0, n_records, block_records):
+            n_block = min(block_records, n_records - start)
+            records = np.array(list(itertools.islice(f, n_block * n_lines))).reshape(n_block, n_lines)
+            block = slice(start, start + n_block)
+            if header:
+                values = np.char.partition(records[:, :n_header], ': ')[..., 2]
+                meta['event_number'][block] = values[:, 3].astype(np.int64)
+                meta['trigger_tag'][block] = values[:, 5].astype(np.int64)
+                meta['first_cell'][block] = values[:, 7].astype(np.int64)
+            else:
+                meta['event_number'][block] = np.arange(start, start + n_block)
+                meta['trigger_tag'][block] = meta['first_cell'][block] = 0
+            waveforms[block] = records[:, n_header:].astype(np.float32)
+        waveforms.flush()
+        meta.flush()
+    return output_prefix
+
+
+def open_channel(path, header, record_length, parsed_prefix=None):
+    """Return (waveforms, event_counter, trigger_tag, first_cell) as memory-mapped arrays."""
+    if parsed_prefix is not None:
+        meta = np.load(f'{parsed_prefix}_meta.npy', mmap_mode='r')
+        waveforms = np.load(f'{parsed_prefix}.npy', mmap_mode='r')
+        return waveforms, meta['event_number'], meta['trigger_tag'], meta['first_cell']
+    reader = wavedumpreader(path, record_length=record_length, header=header)
+    return reader.waveforms, reader.event_counter, reader.trigger_tag, reader.first_cell
+
+
+def unwrap_counter(counter, bits=EVENT_COUNTER_BITS):
+    """Event counter made monotonic by adding 2**bits at every point where it goes back."""
+    counter = np.asarray(counter, dtype=np.int64)
+    wraps = np.concatenate([[0], np.cumsum(np.diff(counter) < 0)])
+    return counter + wraps * (1 << bits)
+
+
+def align_channels(event_counters):
+    """Return (indices into each channel, common event counters) for the events present in all channels.
+
+    The counters have to be unwrapped first (see unwrap_counter), a wrapped
+    counter would match unrelated events of the other channels.
+    """
+    common = reduce(np.intersect1d, event_counters)
+    return [np.intersect1d(common, counter, return_indices=True)[2]
+            for counter in event_counters], common
+
+
+if __name__ == "__main__":
+    args = parser.parse_args()
+    header = not args.no_header
+    if not header and args.record_length is None:
+        sys.exit("❌ --record_length is required with --no_header.")
+
+    files = find_wavedump_files(args.input_dir)
+    if not files:
+        sys.exit(f"❌ No WaveDump wave_N/TR_x_y files found in {args.input_dir}")
+    channels = list(files)
+    print(f"Found {len(files)} channel files: {', '.join(os.path.basename(p) for p in files.values())}")
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        # ASCII parsing is the expensive part, spread it over a process pool
+        ascii_files = {ch: path for ch, path in files.items() if path.endswith('.txt')}
+        parsed = {}
+        if ascii_files:
+            with ProcessPoolExecutor(max_workers=args.workers) as pool:
+                futures = {ch: pool.submit(parse_ascii_file, path, os.path.join(tmpdir, f'ch{ch}'), header, args.record_length)
+                           for ch, path in ascii_files.items()}
+                parsed = {ch: future.result() for ch, future in futures.items()}
+            print(f"Parsed {len(parsed)} ASCII files with {args.workers} workers")
+
+        columns = {ch: open_channel(files[ch], header, args.record_length, parsed.get(ch)) for ch in channels}
+        counters = [unwrap_counter(columns[ch][1]) for ch in channels]
+        for ch, counter in zip(channels, counters):
+            if len(np.unique(counter)) != len(counter):
+                print(f"⚠️ Channel {ch}: repeated event counters, only the first occurrence is used")
+        indices, common = align_channels(counters)
+        print(f"{len(common)} events present in all {len(channels)} channels")
+
+        record_length = columns[channels[0]][0].shape[-1]
+        if args.output.endswith('.root'):
+            writer = rootwriter(args.output, channels, record_length, basket_size=args.chunk_events)
+        else:
+            writer = chunkwriter(args.output)
+        with writer:
+            for start in range(0, len(common), args.chunk_events):
+                rows = [index[start:start + args.chunk_events] for index in indices]
+                # (events, channels, samples), the per-event info is taken from the first channel
+                waveforms = np.stack([columns[ch][0][row] for ch, row in zip(channels, rows)], axis=1)
+                first = columns[channels[0]]
+                # unwrapped counters, unique over the whole file
+                batch = eventbatch(waveforms, channels, common[start:start + args.chunk_events],
+                                   np.asarray(first[2])[rows[0]], np.asarray(first[3])[rows[0]])
+                if isinstance(writer, chunkwriter):
+                    # keep the start index cell of each channel's own group
+                    first_cell = np.stack([np.asarray(columns[ch][3])[row] for ch, row in zip(channels, rows)], axis=1)
+                    writer.write(waveforms.reshape(-1, record_length),
+                                 np.tile(channels, len(waveforms)),
+                                 np.repeat(batch.event_number, len(channels)),
+                                 np.repeat(batch.trigger_tag, len(channels)),
+                                 first_cell.reshape(-1))
+                else:
+                    writer.write_batch(batch)
+                print(f"\rConverted {min(start + args.chunk_events, len(common))} / {len(common)} events", end="")
+    print(f"\nOutput saved as: {args.output}")
@@ -0,0 +1,454 @@
+import os
+import struct
+import numpy as np
+import uproot
+
+from eventbatch import eventbatch
+
+### chunked waveform files (.wfc)
+### file magic, then one chunk per accepted batch, each chunk being two .npy records:
+### the (n, record_length) waveforms and a structured array with the per-waveform info.
+### close() appends an index record and a 16 bytes trailer pointing to it; a file without
+### trailer (interrupted run) is recovered by scanning the chunk headers.
+### With zero suppression the first record holds (n, roi_length) segments instead and the
+### info also carries the segment offset, the full record length and the baseline used as fill.
+
+FILE_MAGIC = b'WFCHUNK\x01'
+INDEX_MAGIC = b'WFCINDEX'
+META_DTYPE = np.dtype([('channel', 'u1'), ('event_number', '<i8'), ('trigger_tag', '<i8'), ('first_cell', '<i4')])
+ROI_META_DTYPE = np.dtype(META_DTYPE.descr + [('offset', '<i4'), ('record_length', '<i4'), ('baseline', '<f4')])
+INDEX_DTYPE = np.dtype([('offset', '<i8'), ('n_waveforms', '<i8')])
+
+
+def find_roi(waveforms, roi_length=150, pre_samples=50):
+    """(offsets, baselines) of the roi_length window around the largest excursion of every waveform."""
+    record_length = waveforms.shape[-1]
+    baselines = np.median(waveforms, axis=-1)
+    peaks = np.abs(waveforms - baselines[..., None]).argmax(axis=-1)
+    offsets = np.clip(peaks - pre_samples, 0, max(record_length - roi_length, 0))
+    return offsets, baselines
+
+
+def extract_roi(waveforms, offsets, roi_length):
+    """(n, roi_length) copy of the segments starting at offsets, through a strided window view."""
+    windows = np.lib.stride_tricks.sliding_window_view(waveforms, roi_length, axis=-1)
+    return windows[np.arange(len(waveforms)), offsets]
+
+
+def expand_roi(segments, meta):
+    """Full records from zero-suppressed segments, samples outside the ROI set to the baseline."""
+    record_length = int(meta['record_length'].max()) if len(meta) else 0
+    fill = meta['baseline']
+    if np.issubdtype(segments.dtype, np.integer):
+        fill = np.rint(fill)
+    full = np.repeat(fill.astype(segments.dtype)[:, None], record_length, axis=1)
+    columns = meta['offset'][:, None] + np.arange(segments.shape[-1])
+    full[np.arange(len(segments))[:, None], columns] = segments
+    return full
+
+
+class chunkwriter:
+    """Append-only writer flushing every batch to disk as its own chunk."""
+
+    def __init__(self, path, fsync=True, roi_length=None, pre_samples=50):
+        self.path = path
+        self.fsync = fsync
+        self.roi_length = roi_length
+        self.pre_samples = pre_samples
+        self.file = open(path, 'wb')
+        self.file.write(FILE_MAGIC)
+        self.index = []
+        self.n_waveforms = 0
+
+
+    def __enter__(self):
+        return self
+
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+        return False
+
+
+    def write(self, waveforms, channel, event_number, trigger_tag, first_cell):
+        """Append one chunk of (n, record_length) waveforms with their per-waveform info."""
+        if len(waveforms) == 0:
+            return
+        waveforms = np.asarray(waveforms)
+        if self.roi_length is not None and self.roi_length < waveforms.shape[-1]:
+            offsets, baselines = find_roi(waveforms, self.roi_length, self.pre_samples)
+            meta = np.empty(len(waveforms), dtype=ROI_META_DTYPE)
+            meta['offset'] = offsets
+            meta['record_length'] = waveforms.shape[-1]
+            meta['baseline'] = baselines
+            waveforms = extract_roi(waveforms, offsets, self.roi_length)
+        else:
+            meta = np.empty(len(waveforms), dtype=META_DTYPE)
+        meta['channel'] = channel
+        meta['event_number'] = event_number
+        meta['trigger_tag'] = trigger_tag
+        meta['first_cell'] = first_cell
+        offset = self.file.tell()
+        np.lib.format.write_array(self.file, np.ascontiguousarray(waveforms), allow_pickle=False)
+        np.lib.format.write_array(self.file, meta, allow_pickle=False)
+        self.file.flush()
+        if self.fsync:
+            os.fsync(self.file.fileno())
+        self.index.append((offset, len(waveforms)))
+        self.n_waveforms += len(waveforms)
+
+
+    def write_batch(self, batch, mask=None):
+        """Append the waveforms of an eventbatch selected by an (events, channels) mask."""
+        if mask is None:
+            mask = np.ones(batch.waveforms.shape[:2], dtype=bool)
+        event_index, channel_index = np.nonzero(mask)
+        self.write(batch.waveforms[event_index, channel_index],
+                   np.asarray(batch.channels)[channel_index],
+                   batch.event_number[event_index],
+                   batch.trigger_tag[event_index],
+                   batch.first_cell[event_index])
+
+
+    def close(self):
+        if self.file.closed:
+            return
+        index_offset = self.file.tell()
+        np.lib.format.write_array(self.file, np.array(self.index, dtype=INDEX_DTYPE), allow_pickle=False)
+        self.file.write(struct.pack('<8sQ', INDEX_MAGIC, index_offset))
+        self.file.close()
+
+
+def read_npy_header(f):
+    """Read a .npy record header, return (shape, dtype, data offset)."""
+    version = np.lib.format.read_magic(f)
+    if version == (1, 0):
+        shape, fortran_order, dtype = np.lib.format.read_array_header_1_0(f)
+    else:
+        shape, fortran_order, dtype = np.lib.format.read_array_header_2_0(f)
+    return shape, dtype, f.tell()
+
+
+class chunkreader:
+    """Read a .wfc file, complete or left behind by an interrupted acquisition.
+
+    Behaves like the NpzFile returned by np.load: files lists the available
+    arrays and reader[key] returns them concatenated over all chunks.
+    Zero-suppressed files are expanded to full records on 'waveforms',
+    the stored segments are available as 'roi'.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.file = open(path, 'rb')
+        if self.file.read(len(FILE_MAGIC)) != FILE_MAGIC:
+            raise ValueError(f'{path} is not a chunked waveform file')
+        self.complete = self.__read_index__()
+        if not self.complete:
+            self.__scan__()
+        meta_names = list(self.read_chunk(0)[1].dtype.names) if self.n_chunks else list(META_DTYPE.names)
+        self.zero_suppressed = 'offset' in meta_names
+        self.files = ['waveforms'] + (['roi'] if self.zero_suppressed else []) + meta_names
+
+
+    def __enter__(self):
+        return self
+
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+        return False
+
+
+    def close(self):
+        self.file.close()
+
+
+    def __read_index__(self):
+        size = os.fstat(self.file.fileno()).st_size
+        if size < len(FILE_MAGIC) + 16:
+            return False
+        self.file.seek(size - 16)
+        magic, index_offset = struct.unpack('<8sQ', self.file.read(16))
+        if magic != INDEX_MAGIC:
+            return False
+        self.file.seek(index_offset)
+        self.index = np.lib.format.read_array(self.file, allow_pickle=False)
+        return True
+
+
+    def __scan__(self):
+        """Rebuild the index from the chunk headers, dropping a truncated last chunk."""
+        size = os.fstat(self.file.fileno()).st_size
+        index = []
+        offset = len(FILE_MAGIC)
+        while offset < size:
+            try:
+                self.file.seek(offset)
+                shape, dtype, data_offset = read_npy_header(self.file)
+                if len(shape) != 2:
+                    break
+                self.file.seek(data_offset + int(np.prod(shape)) * dtype.itemsize)
+                meta_shape, meta_dtype, meta_offset = read_npy_header(self.file)
+                end = meta_offset + int(np.prod(meta_shape)) * meta_dtype.itemsize
+            except (ValueError, EOFError):
+                break
+            if end > size:
+                break
+            index.append((offset, shape[0]))
+            offset = end
+        self.index = np.array(index, dtype=INDEX_DTYPE)
+
+
+    def __len__(self):
+        return int(self.index['n_waveforms'].sum())
+
+
+    @property
+    def n_chunks(self):
+        return len(self.index)
+
+
+    def read_chunk(self, i):
+        """Return (waveforms, meta) of chunk i."""
+        self.file.seek(self.index['offset'][i])
+        waveforms = np.lib.format.read_array(self.file, allow_pickle=False)
+        meta = np.lib.format.read_array(self.file, allow_pickle=False)
+        return waveforms, meta
+
+
+    def read_full_chunk(self, i):
+        """Return (waveforms, meta) of chunk i with zero-suppressed segments expanded to full records."""
+        waveforms, meta = self.read_chunk(i)
+        if self.zero_suppressed:
+            waveforms = expand_roi(waveforms, meta)
+        return waveforms, meta
+
+
+    def __iter__(self):
+        for i in range(self.n_chunks):
+            yield self.read_chunk(i)
+
+
+    def __getitem__(self, key):
+        if key not in self.files:
+            raise KeyError(key)
+        if key == 'waveforms':
+            chunks = [self.read_full_chunk(i)[0] for i in range(self.n_chunks)]
+        else:
+            chunks = [waveforms if key == 'roi' else meta[key] for waveforms, meta in self]
+        if not chunks:
+            return np.empty(0)
+        return np.concatenate(chunks)
+
+
+class rootwriter:
+    """Append event batches to a single TTree, one basket every basket_size events.
+
+    The tree has event_number, trigger_tag and first_cell branches plus a
+    fixed-size waveform_ch<N> branch per channel, float32 or e.g. uint16 for quantized data.
+    """
+
+    def __init__(self, path, channels, record_length, tree_name='waveform_tree', basket_size=1024, dtype=np.float32):
+        self.path = path
+        self.channels = tuple(channels)
+        self.basket_size = basket_size
+        self.dtype = np.dtype(dtype)
+        self.file = uproot.recreate(path)
+        branches = {'event_number': np.int64, 'trigger_tag': np.int64, 'first_cell': np.int32}
+        for ch in self.channels:
+            branches[f'waveform_ch{ch}'] = np.dtype((self.dtype, (record_length,)))
+        self.tree = self.file.mktree(tree_name, branches)
+        self.pending = []
+        self.n_pending = 0
+        self.n_events = 0
+
+
+    def __enter__(self):
+        return self
+
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+        return False
+
+
+    def write_batch(self, batch, mask=None):
+        """Queue the events of an eventbatch (optionally selected by a 1-D event mask)."""
+        if mask is not None:
+            batch = batch[mask]
+        if len(batch) == 0:
+            return
+        self.pending.append(batch.select_channels(self.channels))
+        self.n_pending += len(batch)
+        self.n_events += len(batch)
+        if self.n_pending >= self.basket_size:
+            self.flush()
+
+
+    def flush(self):
+        """Write the queued events as one basket per branch."""
+        if not self.pending:
+            return
+        batch = self.pending[0] if len(self.pending) == 1 else eventbatch.concatenate(self.pending)
+        branches = {
+            'event_number': batch.event_number.astype(np.int64),
+            'trigger_tag': batch.trigger_tag.astype(np.int64),
+            'first_cell': batch.first_cell.astype(np.int32),
+        }
+        for i, ch in enumerate(self.channels):
+            branches[f'waveform_ch{ch}'] = np.ascontiguousarray(batch.waveforms[:, i], dtype=self.dtype)
+        self.tree.extend(branches)
+        self.pending = []
+        self.n_pending = 0
+
+
+    def close(self):
+        if self.file.closed:
+            return
+        self.flush()
+        self.file.close()
+
+
+class featurewriter:
+    """Append pulse feature tables to a flat TTree, one entry per waveform.
+
+    Tables are dicts of equal-length 1-D columns (see features.feature_table),
+    queued and written as one basket every basket_size entries.
+    """
+
+    def __init__(self, path, columns, tree_name='feature_tree', basket_size=65536):
+        self.path = path
+        self.basket_size = basket_size
+        self.file = uproot.recreate(path)
+        self.dtypes = {name: np.dtype(dtype) for name, dtype in columns.items()}
+        self.tree = self.file.mktree(tree_name, self.dtypes)
+        self.pending = []
+        self.n_pending = 0
+        self.n_rows = 0
+
+
+    def __enter__(self):
+        return self
+
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+        return False
+
+
+    def write(self, table):
+        n_rows = len(next(iter(table.values())))
+        if n_rows == 0:
+            return
+        self.pending.append(table)
+        self.n_pending += n_rows
+        self.n_rows += n_rows
+        if self.n_pending >= self.basket_size:
+            self.flush()
+
+
+    def flush(self):
+        if not self.pending:
+            return
+        self.tree.extend({name: np.concatenate([table[name] for table in self.pending]).astype(dtype)
+                          for name, dtype in self.dtypes.items()})
+        self.pending = []
+        self.n_pending = 0
+
+
+    def close(self):
+        if self.file.closed:
+            return
+        self.flush()
+        self.file.close()
+
+
+def write_channel_map(file, channels, channel_map):
+    """Record in an open uproot file which board each channel came from.
+
+    channel_map holds one ('host:port', board channel) pair per channel; the
+    boards are written as a 'boards' string, the map as a 'channel_map' tree.
+    """
+    boards = list(dict.fromkeys(board for board, _ in channel_map))
+    file['boards'] = ' '.join(boards)
+    tree = file.mktree('channel_map', {'channel': np.uint8, 'board': np.int32, 'board_channel': np.uint8})
+    tree.extend({
+        'channel': np.asarray(channels, dtype=np.uint8),
+        'board': np.array([boards.index(board) for board, _ in channel_map], dtype=np.int32),
+        'board_channel': np.array([ch for _, ch in channel_map], dtype=np.uint8),
+    })
+
+
+### WaveDump x742 binary output (wave_N.dat / TR_x_y.dat, OUTPUT_FILE_FORMAT BINARY)
+### every record is an optional 8 x uint32 header followed by the float32 samples
+
+WAVEDUMP_HEADER_FIELDS = ['size', 'board_id', 'pattern', 'channel', 'event_counter',
+                          'trigger_time_tag', 'dc_offset', 'start_index_cell']
+
+
+class wavedumpreader:
+    """Memory-mapped view of a WaveDump x742 binary file.
+
+    The file is mapped as an array of fixed-size records, so opening it only
+    reads the first header and checks the others in one vectorized pass.
+    Without OUTPUT_FILE_HEADER the record_length has to be given.
+    """
+
+    def __init__(self, path, record_length=None, header=True):
+        self.path = path
+        self.header = header
+        if header:
+            first = np.fromfile(path, dtype='<u4', count=8)
+            if len(first) < 8:
+                raise ValueError(f'{path} does not contain a complete WaveDump header')
+            record_length = (int(first[0]) - 8 * 4) // 4
+            fields = [(name, '<u4') for name in WAVEDUMP_HEADER_FIELDS]
+        elif record_length is None:
+            raise ValueError('record_length is required for files written without header')
+        else:
+            fields = []
+        self.record_dtype = np.dtype(fields + [('waveform', '<f4', (record_length,))])
+        self.record_length = record_length
+
+        size = os.path.getsize(path)
+        n_records = size // self.record_dtype.itemsize
+        if size % self.record_dtype.itemsize:
+            print(f'⚠️ {path}: ignoring {size % self.record_dtype.itemsize} trailing bytes of a truncated record')
+        self.records = np.memmap(path, dtype=self.record_dtype, mode='r', shape=(n_records,))
+        if header and n_records and np.any(self.records['size'] != self.record_dtype.itemsize):
+            raise ValueError(f'{path}: records with different lengths are not supported')
+
+
+    def __len__(self):
+        return len(self.records)
+
+
+    def __getitem__(self, key):
+        """Header field or 'waveform' column (memory-mapped), or a slice of records."""
+        return self.records[key]
+
+
+    @property
+    def waveforms(self):
+        return self.records['waveform']
+
+
+    @property
+    def event_counter(self):
+        return self.records['event_counter'] if self.header else np.arange(len(self))
+
+
+    @property
+    def trigger_tag(self):
+        return self.records['trigger_time_tag'] if self.header else np.zeros(len(self), dtype=np.uint32)
+
+
+    @property
+    def first_cell(self):
+        return self.records['start_index_cell'] if self.header else np.zeros(len(self), dtype=np.uint32)
+
+
+    def to_eventbatch(self, channel=0):
+        """Single-channel eventbatch backed by the memory map."""
+        return eventbatch(self.waveforms[:, None], [channel], self.event_counter, self.trigger_tag, self.first_cell)